@@ -0,0 +1,223 @@
+"""
+Records the JSON-RPC traffic between a shovel and an archive node, and replays it from a local
+websocket server so shovels can be benchmarked without network access.
+
+    # Proxy to a real node, recording every response
+    python rpc_replay/main.py record --upstream ws://archive:9944 --recording run.json.gz
+
+    # Serve the recording with 20ms +/- 5ms of simulated latency
+    python rpc_replay/main.py serve --recording run.json.gz --latency-ms 20 --jitter-ms 5
+
+In both modes point the shovel at the local server with SUBSTRATE_ARCHIVE_NODE_URL.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import random
+import signal
+
+import websockets
+
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s %(process)d %(message)s")
+
+# Notifications kept per subscription, enough for clients that wait on the first few
+MAX_NOTIFICATIONS = 16
+
+
+def request_key(method, params):
+    return json.dumps([method, params], separators=(",", ":"), sort_keys=True)
+
+
+def as_list(payload):
+    return payload if isinstance(payload, list) else [payload]
+
+
+def load_recording(path):
+    with gzip.open(path, "rt") as f:
+        return json.load(f)
+
+
+def save_recording(path, recording):
+    with gzip.open(path, "wt") as f:
+        json.dump(recording, f)
+    logging.info(f"Saved {len(recording)} recorded responses to {path}")
+
+
+class Recorder:
+    """
+    Websocket proxy that forwards every message to the upstream node and records the responses,
+    keyed by method and params.
+    """
+
+    def __init__(self, upstream, path):
+        self.upstream = upstream
+        self.path = path
+        try:
+            self.recording = load_recording(path)
+            logging.info(f"Appending to existing recording with {len(self.recording)} responses")
+        except FileNotFoundError:
+            self.recording = {}
+
+    async def handle(self, client_ws):
+        pending = {}
+        subscriptions = {}
+
+        async with websockets.connect(self.upstream, max_size=None) as upstream_ws:
+            async def client_to_upstream():
+                async for message in client_ws:
+                    for request in as_list(json.loads(message)):
+                        pending[request["id"]] = request_key(
+                            request["method"], request.get("params", [])
+                        )
+                    await upstream_ws.send(message)
+
+            async def upstream_to_client():
+                async for message in upstream_ws:
+                    for response in as_list(json.loads(message)):
+                        self.record(response, pending, subscriptions)
+                    await client_ws.send(message)
+
+            tasks = [
+                asyncio.ensure_future(client_to_upstream()),
+                asyncio.ensure_future(upstream_to_client()),
+            ]
+            try:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    def record(self, response, pending, subscriptions):
+        if "id" in response and response["id"] in pending:
+            key = pending.pop(response["id"])
+            entry = {"result": response.get("result"), "error": response.get("error")}
+            self.recording[key] = entry
+            # Subscription ids are strings or ints returned by *_subscribe* methods
+            if "subscribe" in key.lower() and response.get("result") is not None:
+                entry["notifications"] = []
+                subscriptions[response["result"]] = entry
+        elif response.get("method") and isinstance(response.get("params"), dict):
+            entry = subscriptions.get(response["params"].get("subscription"))
+            if entry is not None and len(entry["notifications"]) < MAX_NOTIFICATIONS:
+                entry["notifications"].append(
+                    {"method": response["method"], "result": response["params"].get("result")}
+                )
+
+    async def autosave(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            save_recording(self.path, self.recording)
+
+
+class Replayer:
+    """
+    Websocket server answering requests from a recording, with simulated latency and jitter.
+    Requests that were never recorded get a JSON-RPC error so the run fails loudly.
+    """
+
+    def __init__(self, path, latency_ms, jitter_ms):
+        self.recording = load_recording(path)
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.misses = 0
+        logging.info(f"Loaded {len(self.recording)} recorded responses from {path}")
+
+    async def handle(self, client_ws):
+        tasks = set()
+        async for message in client_ws:
+            for request in as_list(json.loads(message)):
+                task = asyncio.ensure_future(self.respond(client_ws, request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+    async def respond(self, client_ws, request):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        method = request["method"]
+        entry = self.recording.get(request_key(method, request.get("params", [])))
+        response = {"jsonrpc": "2.0", "id": request["id"]}
+
+        if entry is not None:
+            if entry.get("error") is not None:
+                response["error"] = entry["error"]
+            else:
+                response["result"] = entry["result"]
+        elif "unsubscribe" in method.lower():
+            response["result"] = True
+        else:
+            self.misses += 1
+            logging.warning(f"No recorded response for {method} {request.get('params')}")
+            response["error"] = {"code": -32601, "message": f"No recorded response for {method}"}
+
+        try:
+            await client_ws.send(json.dumps(response))
+            for notification in (entry or {}).get("notifications", []):
+                await client_ws.send(json.dumps({
+                    "jsonrpc": "2.0",
+                    "method": notification["method"],
+                    "params": {"subscription": entry["result"], "result": notification["result"]},
+                }))
+        except websockets.ConnectionClosed:
+            pass
+
+
+async def record(args):
+    recorder = Recorder(args.upstream, args.recording)
+    autosave = asyncio.ensure_future(recorder.autosave())
+    try:
+        async with websockets.serve(recorder.handle, args.host, args.port, max_size=None):
+            logging.info(f"Recording {args.upstream} on ws://{args.host}:{args.port}")
+            await wait_for_shutdown()
+    finally:
+        autosave.cancel()
+        save_recording(args.recording, recorder.recording)
+
+
+async def serve(args):
+    replayer = Replayer(args.recording, args.latency_ms, args.jitter_ms)
+    async with websockets.serve(replayer.handle, args.host, args.port, max_size=None):
+        logging.info(f"Replaying on ws://{args.host}:{args.port}")
+        await wait_for_shutdown()
+    logging.info(f"Served with {replayer.misses} unrecorded requests")
+
+
+async def wait_for_shutdown():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="Proxy to an archive node and record responses")
+    record_parser.add_argument("--upstream", required=True)
+    record_parser.add_argument("--recording", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Replay recorded responses")
+    serve_parser.add_argument("--recording", required=True)
+    serve_parser.add_argument("--latency-ms", type=float, default=0)
+    serve_parser.add_argument("--jitter-ms", type=float, default=0)
+
+    for subparser in (record_parser, serve_parser):
+        subparser.add_argument("--host", default="127.0.0.1")
+        subparser.add_argument("--port", type=int, default=9944)
+
+    args = parser.parse_args()
+    if args.command == "record":
+        asyncio.run(record(args))
+    else:
+        asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+from bisect import bisect_right
+
+from shared.clickhouse.utils import get_clickhouse_client, table_exists
+
+STAKES_CHANGES_TABLE = "shovel_stake_double_map_changes"
+STAKES_AS_OF_VIEW = "shovel_stake_double_map_as_of"
+OWNER_CHANGES_TABLE = "shovel_hotkey_owner_changes"
+OWNER_AS_OF_VIEW = "shovel_hotkey_owner_as_of"
+
+
+class AsOfIndex:
+    """
+    In-process index of values that change at blocks, answering "value of key at block N" with a
+    binary search over the changes of that key.
+    """
+
+    def __init__(self):
+        self.blocks = {}
+        self.values = {}
+
+    def add(self, key, block_number, value):
+        """
+        Records that `key` changed to `value` at `block_number`, None meaning removed. Changes are
+        expected in block order per key.
+        """
+        blocks = self.blocks.setdefault(key, [])
+        values = self.values.setdefault(key, [])
+        if blocks and blocks[-1] == block_number:
+            values[-1] = value
+        else:
+            blocks.append(block_number)
+            values.append(value)
+
+    def get(self, key, block_number, default=None):
+        blocks = self.blocks.get(key)
+        if not blocks:
+            return default
+        i = bisect_right(blocks, block_number)
+        if i == 0 or self.values[key][i - 1] is None:
+            return default
+        return self.values[key][i - 1]
+
+    def keys(self):
+        return self.blocks.keys()
+
+
+def create_stakes_as_of_view():
+    """
+    Creates a parameterized view giving the full stake map at a block from the change-log layout
+    of the stake map shovel:
+
+        SELECT * FROM shovel_stake_double_map_as_of(block_number = 4000000)
+
+    The state is the last full snapshot at or before the block, with every change written since
+    applied on top of it.
+    """
+    if table_exists(STAKES_AS_OF_VIEW):
+        return
+    query = f"""
+    CREATE VIEW IF NOT EXISTS {STAKES_AS_OF_VIEW} AS
+    SELECT
+        hotkey,
+        coldkey,
+        argMax(stake, block_number) AS stake,
+        max(block_number) AS changed_at_block
+    FROM {STAKES_CHANGES_TABLE}
+    WHERE block_number <= {{block_number:UInt64}}
+      AND block_number >= (
+          SELECT max(block_number)
+          FROM {STAKES_CHANGES_TABLE}
+          WHERE is_snapshot = 1 AND block_number <= {{block_number:UInt64}}
+      )
+    GROUP BY hotkey, coldkey
+    """
+    get_clickhouse_client().execute(query)
+
+
+def get_stakes_as_of(block_number, hotkeys=None):
+    """
+    Returns {(hotkey, coldkey): stake} at `block_number`, optionally only for the given hotkeys.
+    """
+    query = f"SELECT hotkey, coldkey, stake FROM {STAKES_AS_OF_VIEW}(block_number = {int(block_number)})"
+    if hotkeys is not None:
+        hotkeys = list(hotkeys)
+        if not hotkeys:
+            return {}
+        hotkeys_list = ", ".join(f"'{hotkey}'" for hotkey in hotkeys)
+        query += f" WHERE hotkey IN ({hotkeys_list})"
+    rows = get_clickhouse_client().execute(query)
+    return {(hotkey, coldkey): stake for (hotkey, coldkey, stake) in rows}
+
+
+def create_owner_changes_table():
+    """
+    Creates the change-log layout of the hotkey owner map, a row per hotkey whose owner changed
+    with an empty coldkey when the hotkey was removed, and its parameterized as-of view:
+
+        SELECT * FROM shovel_hotkey_owner_as_of(block_number = 4000000)
+    """
+    if not table_exists(OWNER_CHANGES_TABLE):
+        query = f"""
+        CREATE TABLE IF NOT EXISTS {OWNER_CHANGES_TABLE} (
+            block_number UInt64 CODEC(Delta, ZSTD),
+            timestamp DateTime CODEC(Delta, ZSTD),
+            hotkey String CODEC(ZSTD),
+            coldkey String CODEC(ZSTD)
+        ) ENGINE = ReplacingMergeTree()
+        ORDER BY (hotkey, block_number)
+        """
+        get_clickhouse_client().execute(query)
+
+    if not table_exists(OWNER_AS_OF_VIEW):
+        query = f"""
+        CREATE VIEW IF NOT EXISTS {OWNER_AS_OF_VIEW} AS
+        SELECT hotkey, coldkey
+        FROM (
+            SELECT hotkey, argMax(coldkey, block_number) AS coldkey
+            FROM {OWNER_CHANGES_TABLE}
+            WHERE block_number <= {{block_number:UInt64}}
+            GROUP BY hotkey
+        )
+        WHERE coldkey != ''
+        """
+        get_clickhouse_client().execute(query)
+
+
+def get_owners_as_of(block_number, hotkeys=None):
+    """
+    Returns {hotkey: coldkey} at `block_number`, optionally only for the given hotkeys. The table
+    is ordered by hotkey then block, so looking up a few hotkeys only reads their changes.
+    """
+    query = f"SELECT hotkey, coldkey FROM {OWNER_AS_OF_VIEW}(block_number = {int(block_number)})"
+    if hotkeys is not None:
+        hotkeys = list(hotkeys)
+        if not hotkeys:
+            return {}
+        hotkeys_list = ", ".join(f"'{hotkey}'" for hotkey in hotkeys)
+        query = f"""
+        SELECT hotkey, argMax(coldkey, block_number) AS coldkey
+        FROM {OWNER_CHANGES_TABLE}
+        WHERE hotkey IN ({hotkeys_list}) AND block_number <= {int(block_number)}
+        GROUP BY hotkey
+        HAVING coldkey != ''
+        """
+    rows = get_clickhouse_client().execute(query)
+    return {hotkey: coldkey for (hotkey, coldkey) in rows}
+
+
+def load_owner_index(from_block_number=0):
+    """
+    Loads the owner change log into an AsOfIndex for many point-in-time lookups in process.
+    """
+    index = AsOfIndex()
+    query = f"""
+    SELECT hotkey, block_number, coldkey
+    FROM {OWNER_CHANGES_TABLE} FINAL
+    WHERE block_number >= {int(from_block_number)}
+    ORDER BY hotkey, block_number
+    """
+    for (hotkey, block_number, coldkey) in get_clickhouse_client().execute(query):
+        index.add(hotkey, block_number, coldkey or None)
+    return index
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from tqdm import tqdm
+
+from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
+from shared.shovel_base_class import ShovelBaseClass
+from shared.substrate import close_async_substrate_client
+
+
+class AsyncShovelBaseClass(ShovelBaseClass):
+    """
+    Base class for shovels whose `process_block` is a coroutine.
+
+    Up to `concurrency` blocks are processed at once on a single event loop. The checkpoint only
+    advances to the highest block for which every earlier block has completed, so a restart never
+    skips a block that was still in flight.
+    """
+
+    concurrency = 16
+
+    def __init__(self, name, skip_interval=1, concurrency=None):
+        super().__init__(name, skip_interval)
+        if concurrency is not None:
+            self.concurrency = concurrency
+        self.loop = asyncio.new_event_loop()
+
+    async def process_block(self, n):
+        raise NotImplementedError(
+            "Please implement the async process_block method in your shovel class!"
+        )
+
+    def process_blocks(self, block_numbers):
+        try:
+            self.loop.run_until_complete(self._process_blocks(block_numbers))
+        except Exception:
+            # Like reconnect_substrate, retries start from a fresh connection
+            self.loop.run_until_complete(close_async_substrate_client())
+            raise
+
+    async def _process_block(self, block_number):
+        try:
+            await self.process_block(block_number)
+        except DatabaseConnectionError as e:
+            logging.error(f"Database connection error while processing block {block_number}: {str(e)}")
+            raise
+        except Exception as e:
+            logging.error(f"Fatal error while processing block {block_number}: {str(e)}")
+            raise ShovelProcessingError(f"Failed to process block {block_number}: {str(e)}")
+
+    async def _process_blocks(self, block_numbers):
+        pending = set()
+        completed = set()
+        next_index = 0
+
+        def advance_checkpoint(finished):
+            nonlocal next_index
+            for task in finished:
+                # Raises the block's error, if any
+                completed.add(task.result())
+            while next_index < len(block_numbers) and block_numbers[next_index] in completed:
+                completed.remove(block_numbers[next_index])
+                self.checkpoint_block_number = block_numbers[next_index]
+                next_index += 1
+            progress.update(len(finished))
+
+        async def run(block_number):
+            await self._process_block(block_number)
+            return block_number
+
+        progress = tqdm(total=len(block_numbers))
+        try:
+            for block_number in block_numbers:
+                if len(pending) >= self.concurrency:
+                    finished, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    advance_checkpoint(finished)
+                pending.add(asyncio.ensure_future(run(block_number)))
+
+            while pending:
+                finished, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                advance_checkpoint(finished)
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise
+        finally:
+            progress.close()
@@ -0,0 +1,119 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from scalecodec.base import ScaleBytes
+
+from shared.block_metadata import get_block_metadata
+from shared.event_decoding import decode_events, fetch_raw_events
+from shared.metadata_types import get_metadata_types
+from shared.substrate import get_substrate_client
+
+BLOCK_BUNDLE_CACHE_SIZE = int(os.getenv("BLOCK_BUNDLE_CACHE_SIZE", "64"))
+
+
+class BlockBundle:
+    """
+    Everything fetched from the archive node for one block: its hash, timestamp, SCALE encoded
+    extrinsics and SCALE encoded events. Extrinsics and events are only decoded when first used,
+    so shovels that share a bundle share the decoding too.
+    """
+
+    def __init__(self, block_number, block_hash, timestamp, raw_extrinsics, raw_events):
+        self.block_number = block_number
+        self.block_hash = block_hash
+        self.timestamp = timestamp
+        self.raw_extrinsics = raw_extrinsics
+        self.raw_events = raw_events
+        self.lock = threading.Lock()
+        self._extrinsics = None
+        self._events = {}
+        self._metadata_types = None
+        # Results of shared.decode_pool.decode_block, per transform
+        self.transformed = {}
+
+    @property
+    def extrinsics(self):
+        """
+        Decoded extrinsics, the same as `substrate.get_extrinsics(...)[i].value`.
+        """
+        with self.lock:
+            if self._extrinsics is None:
+                substrate = get_substrate_client()
+                substrate.init_runtime(block_hash=self.block_hash)
+                extrinsics = []
+                for raw in self.raw_extrinsics:
+                    # substrate.create_scale_object without a block hash would switch back to the head runtime
+                    extrinsic = substrate.runtime_config.create_scale_object(
+                        "Extrinsic", data=ScaleBytes(raw), metadata=substrate.metadata
+                    )
+                    extrinsic.decode()
+                    extrinsics.append(extrinsic.value)
+                self._extrinsics = extrinsics
+                self._metadata_types = get_metadata_types(substrate)
+            return self._extrinsics
+
+    def events(self, event_filter=None):
+        """
+        Decoded events, see `shared.event_decoding.decode_events`. Results are kept per filter.
+        """
+        with self.lock:
+            if event_filter not in self._events:
+                substrate = get_substrate_client()
+                self._events[event_filter] = decode_events(
+                    substrate, self.block_hash, self.raw_events, event_filter
+                )
+                self._metadata_types = get_metadata_types(substrate)
+            return self._events[event_filter]
+
+    @property
+    def metadata_types(self):
+        """
+        Column types of the runtime the block was decoded with, see `shared.metadata_types`.
+        """
+        with self.lock:
+            if self._metadata_types is None:
+                substrate = get_substrate_client()
+                substrate.init_runtime(block_hash=self.block_hash)
+                self._metadata_types = get_metadata_types(substrate)
+            return self._metadata_types
+
+
+def fetch_block_bundle(n):
+    substrate = get_substrate_client()
+    (block_timestamp, block_hash) = get_block_metadata(n)
+    block = substrate.rpc_request("chain_getBlock", [block_hash])["result"]
+    raw_events = fetch_raw_events(substrate, block_hash)
+    return BlockBundle(n, block_hash, block_timestamp, block["block"]["extrinsics"], raw_events)
+
+
+bundles = OrderedDict()
+bundles_lock = threading.Lock()
+
+
+def get_block_bundle(n):
+    """
+    Returns the bundle for block n. The last BLOCK_BUNDLE_CACHE_SIZE bundles are kept in memory,
+    and concurrent callers asking for the same block wait on a single fetch.
+    """
+    with bundles_lock:
+        future = bundles.get(n)
+        fetching = future is None
+        if fetching:
+            future = Future()
+            bundles[n] = future
+            while len(bundles) > BLOCK_BUNDLE_CACHE_SIZE:
+                bundles.popitem(last=False)
+        else:
+            bundles.move_to_end(n)
+
+    if fetching:
+        try:
+            future.set_result(fetch_block_bundle(n))
+        except Exception as e:
+            with bundles_lock:
+                if bundles.get(n) is future:
+                    del bundles[n]
+            future.set_exception(e)
+
+    return future.result()
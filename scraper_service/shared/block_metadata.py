@@ -1,15 +1,19 @@
+import asyncio
+import threading
 from shared.clickhouse.utils import get_clickhouse_client
-from shared.substrate import get_substrate_client
+from shared.substrate import get_async_substrate_client, get_substrate_client
 
 timestamps = dict()
+# Blocks may be prefetched from several threads, and the alpha to tao shovel looks up many
+# blocks concurrently
+timestamps_lock = threading.Lock()
 
 
 def refresh_timestamp_dict(n):
     """
-    Caches n -> n+10k timestamps
+    Caches n -> n+10k timestamps. Call with timestamps_lock held.
     """
     clickhouse = get_clickhouse_client()
-    timestamps.clear()
 
     # Fetch 10k timestamps at a time
     query = f"""
@@ -18,20 +22,34 @@ def refresh_timestamp_dict(n):
         WHERE block_number >= {n} AND block_number < {n + 10_000}
     """
     r = clickhouse.execute(query)
+    timestamps.clear()
     for (timestamp, block_number) in r:
         timestamps[block_number] = timestamp
 
 
+def get_cached_block_timestamp(n):
+    """
+    Returns the timestamp of block n from shovel_block_timestamps, or None when it isn't there yet.
+    """
+    # Held across the refresh, so another thread's refresh can't clear n before it is read
+    with timestamps_lock:
+        timestamp = timestamps.get(n)
+        if timestamp is None:
+            refresh_timestamp_dict(n)
+            timestamp = timestamps.get(n)
+
+    if timestamp is not None:
+        return int(timestamp.timestamp())
+    return None
+
+
 def get_block_timestamp(n, block_hash):
     """
     First tries to fetch from cache, then chain.
     """
-    if n not in timestamps:
-        refresh_timestamp_dict(n)
-
-    if n in timestamps:
-        substrate = get_substrate_client()
-        return int(timestamps[n].timestamp())
+    timestamp = get_cached_block_timestamp(n)
+    if timestamp is not None:
+        return timestamp
     else:
         print("WARN: Block n timestamp not found in Clickhouse, falling back to chain")
         substrate = get_substrate_client()
@@ -59,3 +77,20 @@ def get_block_metadata(n):
     block_timestamp = get_block_timestamp(n, block_hash)
 
     return (block_timestamp, block_hash)
+
+
+async def get_async_block_metadata(n):
+    """
+    Like get_block_metadata, but reads the chain through the event loop's async client. Only the
+    Clickhouse timestamp lookup runs on a thread.
+    """
+    substrate = await get_async_substrate_client()
+    block_hash = await substrate.get_block_hash(n)
+
+    block_timestamp = await asyncio.to_thread(get_cached_block_timestamp, n)
+    if block_timestamp is None:
+        print("WARN: Block n timestamp not found in Clickhouse, falling back to chain")
+        now = await substrate.query("Timestamp", "Now", block_hash=block_hash)
+        block_timestamp = int(now.value / 1000)
+
+    return (block_timestamp, block_hash)
@@ -0,0 +1,55 @@
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from shared.block_bundle import BLOCK_BUNDLE_CACHE_SIZE
+
+
+class BlockPrefetcher:
+    """
+    Runs `prefetch_block(n)` for upcoming blocks on a thread pool while the shovel processes the
+    current one, so fetching and decoding overlap with formatting and buffering.
+
+    `prefetch_block` is expected to warm the block bundle cache, e.g. by fetching the bundle and
+    decoding its extrinsics. The shovel then finds the work done, or waits on the fetch in flight,
+    when it asks for the same bundle.
+    """
+
+    def __init__(self, prefetch_block, workers, lookahead=None):
+        self.prefetch_block = prefetch_block
+        self.workers = workers
+        # Anything further ahead than the cache holds would be evicted before it is used
+        self.lookahead = min(lookahead or workers * 4, BLOCK_BUNDLE_CACHE_SIZE // 2)
+        # Kept for the prefetcher's lifetime, so the substrate clients of its threads are reused
+        # instead of a new pool, and new connections, for every range of blocks
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def iterate(self, block_numbers):
+        """
+        Yields block_numbers in order, with up to `lookahead` of the following blocks prefetching.
+        """
+        remaining = iter(block_numbers)
+        pending = deque()
+
+        def submit_next():
+            block_number = next(remaining, None)
+            if block_number is not None:
+                pending.append((block_number, self.executor.submit(self._prefetch, block_number)))
+
+        try:
+            for _ in range(self.lookahead):
+                submit_next()
+            while pending:
+                (block_number, _) = pending.popleft()
+                submit_next()
+                yield block_number
+        finally:
+            for (_, future) in pending:
+                future.cancel()
+
+    def _prefetch(self, block_number):
+        try:
+            self.prefetch_block(block_number)
+        except Exception as e:
+            # The shovel fetches the block again and handles the error itself
+            logging.warning(f"Failed to prefetch block {block_number}: {str(e)}")
@@ -1,4 +1,6 @@
 import threading
+import contextvars
+from contextlib import contextmanager
 from time import sleep
 from shared.clickhouse.utils import get_clickhouse_client
 import logging
@@ -15,8 +17,57 @@ def debug_log(message: str):
     if _DEBUG_MODE:
         logging.info(f"[ClickHouse DEBUG] {message}")
 
-buffer = {}
-buffer_lock = threading.Lock()
+
+class InsertBuffer:
+    """
+    Rows queued for insertion, per table, until the next flush.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    def insert(self, table_name, row):
+        with self.lock:
+            if table_name not in self.rows:
+                self.rows[table_name] = []
+                debug_log(f"Created new buffer for table {table_name}")
+
+            self.rows[table_name].append(row)
+            debug_log(f"Added row to buffer for table {table_name}. Buffer size: {len(self.rows[table_name])}")
+
+        # Throttle if buffer is getting too large
+        while table_name in self.rows and len(self.rows[table_name]) > 1_000_000:
+            debug_log(f"Buffer for table {table_name} too large ({len(self.rows[table_name])} rows), throttling...")
+            sleep(1)
+
+    def take(self):
+        """
+        Empties the buffer, returning [(table_name, rows)].
+        """
+        with self.lock:
+            tasks = [(table_name, rows) for table_name, rows in self.rows.items()]
+            self.rows.clear()
+        return tasks
+
+
+default_buffer = InsertBuffer()
+
+# Shovels sharing a process each get their own buffer, so rows are only checkpointed with the
+# shovel that produced them
+current_buffer = contextvars.ContextVar("current_buffer", default=default_buffer)
+
+
+@contextmanager
+def use_buffer(insert_buffer):
+    """
+    Routes `buffer_insert` calls made in this context to `insert_buffer`.
+    """
+    token = current_buffer.set(insert_buffer)
+    try:
+        yield insert_buffer
+    finally:
+        current_buffer.reset(token)
 
 
 def batch_insert_into_clickhouse_table(table, rows):
@@ -51,35 +102,24 @@ def buffer_insert(table_name, row):
     """
     Queues a row for insertion. This should be the only way data is inserted into Clickhouse.
     """
-    global buffer
     debug_log(f"Buffer insert called for table {table_name}")
-    with buffer_lock:
-        if table_name not in buffer:
-            buffer[table_name] = []
-            debug_log(f"Created new buffer for table {table_name}")
-
-        buffer[table_name].append(row)
-        debug_log(f"Added row to buffer for table {table_name}. Buffer size: {len(buffer[table_name])}")
-
-    # Throttle if buffer is getting too large
-    while table_name in buffer and len(buffer[table_name]) > 1_000_000:
-        debug_log(f"Buffer for table {table_name} too large ({len(buffer[table_name])} rows), throttling...")
-        sleep(1)
+    current_buffer.get().insert(table_name, row)
 
 
 # Continuously flush the buffer
-def flush_buffer(executor, started_cb, done_cb):
+def flush_buffer(executor, started_cb, done_cb, insert_buffer=None):
     """
-    Continuously flush the buffer.
+    Continuously flush the buffer, or `insert_buffer` if given.
     """
-    global buffer
+    if insert_buffer is not None:
+        # Also routes the checkpoint inserts made from done_cb
+        current_buffer.set(insert_buffer)
+    insert_buffer = current_buffer.get()
     debug_log("Starting buffer flush thread")
     while True:
         started_cb()
-        with buffer_lock:
-            tasks = [(table_name, rows) for table_name, rows in buffer.items()]
-            buffer.clear()
-            debug_log(f"Cleared buffer. Tasks to process: {len(tasks)}")
+        tasks = insert_buffer.take()
+        debug_log(f"Cleared buffer. Tasks to process: {len(tasks)}")
 
         futures = [
             executor.submit(batch_insert_into_clickhouse_table,
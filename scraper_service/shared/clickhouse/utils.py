@@ -1,4 +1,5 @@
 import os
+import json
 import time
 from clickhouse_driver import Client
 from functools import lru_cache
@@ -57,6 +58,46 @@ def table_exists(table_name):
     return len(result) > 0
 
 
+@lru_cache(maxsize=None)
+def get_column_types(table_name):
+    """
+    Column types of an existing table, in column order.
+    """
+    result = get_clickhouse_client().execute(f"DESCRIBE TABLE {table_name}")
+    return tuple(column[1] for column in result)
+
+
+def is_string_type(column_type):
+    for wrapper in ("Nullable(", "LowCardinality("):
+        while column_type.startswith(wrapper):
+            column_type = column_type[len(wrapper):-1]
+    return column_type == "String" or column_type.startswith("FixedString(")
+
+
+def get_string_conversions(table_name, column_types):
+    """
+    Positions of the values formatted for a non-string type in `column_types` whose column in
+    the existing table is a string, e.g. arrays and numbers of tables created before column types
+    were derived from the metadata. Existing tables keep their types, see `to_string_value`.
+    """
+    table_types = get_column_types(table_name)
+    return tuple(
+        i for i, (column_type, table_type) in enumerate(zip(column_types, table_types))
+        if is_string_type(table_type) and not is_string_type(column_type)
+    )
+
+
+def to_string_value(value):
+    """
+    Formats a value formatted for a non-string column as a string literal instead.
+    """
+    if value is None or value == "NULL":
+        return "NULL"
+    text = json.dumps(value) if isinstance(value, list) else str(value)
+    escaped = text.replace("\\", "\\\\").replace("'", "\\'")
+    return f"'{escaped}'"
+
+
 def get_clickhouse_client(retries=10, delay=1):
     if not hasattr(thread_local, "client"):
         clickhouse_host = os.getenv("CLICKHOUSE_HOST")
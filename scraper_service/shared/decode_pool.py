@@ -0,0 +1,83 @@
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from shared.block_bundle import BlockBundle
+from shared.substrate import get_substrate_client
+
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", "0"))
+
+
+def init_worker():
+    # Connect and load the runtime registry once, not for every block
+    get_substrate_client().init_runtime()
+
+
+def transform_in_worker(block_number, block_hash, timestamp, raw_extrinsics, raw_events, transform):
+    bundle = BlockBundle(block_number, block_hash, timestamp, raw_extrinsics, raw_events)
+    return transform(bundle)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_decode_pool():
+    """
+    Returns the process pool used for decoding, or None if DECODE_WORKERS is not set.
+    """
+    global _pool
+    if DECODE_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            logging.info(f"Starting {DECODE_WORKERS} decode worker processes")
+            # Forking would copy the websocket and buffer threads of the shovel
+            _pool = ProcessPoolExecutor(
+                max_workers=DECODE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+            )
+        return _pool
+
+
+def decode_block(bundle, transform):
+    """
+    Returns `transform(bundle)`, which should decode the bundle and return flattened rows.
+
+    With DECODE_WORKERS set, the raw bundle is shipped to a worker process and only the rows come
+    back, so decoding scales with cores instead of being bound by the GIL. `transform` must then
+    be a module level function and its result picklable. The result is kept on the bundle, so a
+    prefetch thread can start the work that process_block later picks up.
+    """
+    with bundle.lock:
+        future = bundle.transformed.get(transform)
+        computing = future is None
+        if computing:
+            future = Future()
+            bundle.transformed[transform] = future
+
+    if computing:
+        try:
+            pool = get_decode_pool()
+            if pool is None:
+                result = transform(bundle)
+            else:
+                result = pool.submit(
+                    transform_in_worker,
+                    bundle.block_number,
+                    bundle.block_hash,
+                    bundle.timestamp,
+                    bundle.raw_extrinsics,
+                    bundle.raw_events,
+                    transform,
+                ).result()
+            future.set_result(result)
+        except Exception as e:
+            with bundle.lock:
+                bundle.transformed.pop(transform, None)
+            future.set_exception(e)
+
+    return future.result()
@@ -0,0 +1,217 @@
+import os
+import logging
+import threading
+from scalecodec.base import ScaleBytes
+
+# twox128("System") + twox128("Events")
+SYSTEM_EVENTS_KEY = "0x26aa394eea5630e07c48ae0c9558cef780d41e5e16056765bc8461851072c9d7"
+
+PRIMITIVE_SIZES = {
+    "bool": 1,
+    "char": 4,
+    "u8": 1,
+    "i8": 1,
+    "u16": 2,
+    "i16": 2,
+    "u32": 4,
+    "i32": 4,
+    "u64": 8,
+    "i64": 8,
+    "u128": 16,
+    "i128": 16,
+    "u256": 32,
+    "i256": 32,
+}
+
+
+class EventFilter:
+    """
+    Include/exclude filter on events, with patterns of the form `Module` or `Module.Event`.
+
+    An event is kept if it matches an include pattern (or no include patterns are set), and does
+    not match any exclude pattern.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.include = set(include)
+        self.exclude = set(exclude)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Reads comma separated patterns from EVENTS_INCLUDE and EVENTS_EXCLUDE, or returns None if
+        neither is set.
+        """
+        include = [p.strip() for p in os.getenv("EVENTS_INCLUDE", "").split(",") if p.strip()]
+        exclude = [p.strip() for p in os.getenv("EVENTS_EXCLUDE", "").split(",") if p.strip()]
+        if not include and not exclude:
+            return None
+        return cls(include, exclude)
+
+    def matches(self, module_id, event_id):
+        if module_id in self.exclude or f"{module_id}.{event_id}" in self.exclude:
+            return False
+        if not self.include:
+            return True
+        return module_id in self.include or f"{module_id}.{event_id}" in self.include
+
+
+class EventLayout:
+    """
+    What is needed to skip over an event record without decoding it, derived from the portable
+    type registry of one runtime: the name of every (pallet index, variant index) and the encoded
+    size of its fields, when that size is fixed.
+    """
+
+    def __init__(self, metadata):
+        self.types = {t["id"]: t["type"]["def"] for t in metadata["types"]["types"]}
+        self.sizes = {}
+        self.names = {}
+        self.field_sizes = {}
+
+        for pallet in metadata["pallets"]:
+            if pallet["name"] == "System":
+                for entry in pallet["storage"]["entries"]:
+                    if entry["name"] == "Events":
+                        events_type = self.types[entry["type"]["Plain"]]
+                        self.record_type = f"scale_info::{events_type['sequence']['type']}"
+
+            if pallet["event"] is None:
+                continue
+            for variant in self.types[pallet["event"]["ty"]]["variant"]["variants"]:
+                key = (pallet["index"], variant["index"])
+                self.names[key] = (pallet["name"], variant["name"])
+                self.field_sizes[key] = self.fields_size(variant["fields"])
+
+    def fields_size(self, fields):
+        size = 0
+        for field in fields:
+            field_size = self.type_size(field["type"])
+            if field_size is None:
+                return None
+            size += field_size
+        return size
+
+    def type_size(self, type_id):
+        """
+        Encoded size of a type, or None if it depends on the value.
+        """
+        if type_id in self.sizes:
+            return self.sizes[type_id]
+        # Recursive types are never fixed size
+        self.sizes[type_id] = None
+
+        type_def = self.types[type_id]
+        size = None
+        if "primitive" in type_def:
+            size = PRIMITIVE_SIZES.get(type_def["primitive"])
+        elif "composite" in type_def:
+            size = self.fields_size(type_def["composite"]["fields"])
+        elif "array" in type_def:
+            item_size = self.type_size(type_def["array"]["type"])
+            if item_size is not None:
+                size = type_def["array"]["len"] * item_size
+        elif "tuple" in type_def:
+            size = self.fields_size([{"type": t} for t in type_def["tuple"]])
+        elif "variant" in type_def:
+            # Only enums without data, e.g. Pays::Yes, have a fixed size
+            if all(len(v["fields"]) == 0 for v in type_def["variant"]["variants"]):
+                size = 1
+
+        self.sizes[type_id] = size
+        return size
+
+
+layouts = {}
+layouts_lock = threading.Lock()
+
+
+def get_event_layout(substrate):
+    """
+    Returns the EventLayout of the runtime substrate is currently initialised with, or None if the
+    runtime has no portable type registry (metadata before V14).
+    """
+    spec_version = substrate.runtime_version
+    with layouts_lock:
+        if spec_version not in layouts:
+            try:
+                versioned = substrate.metadata.value[1]
+                layouts[spec_version] = EventLayout(next(iter(versioned.values())))
+            except Exception as e:
+                logging.warning(f"Cannot skip events for spec version {spec_version}: {str(e)}")
+                layouts[spec_version] = None
+        return layouts[spec_version]
+
+
+def fetch_raw_events(substrate, block_hash):
+    """
+    Returns the SCALE encoded System.Events of a block as a hex string.
+    """
+    return substrate.rpc_request("state_getStorage", [SYSTEM_EVENTS_KEY, block_hash])["result"]
+
+
+def decode_events(substrate, block_hash, raw_events, event_filter=None):
+    """
+    Decodes the System.Events of a block into the same dicts as `substrate.query("System",
+    "Events")[i].value`, plus the position of the event in the block as `record_index`.
+
+    Events rejected by `event_filter` are skipped after reading only their pallet and variant
+    index, without decoding their attributes.
+    """
+    substrate.init_runtime(block_hash=block_hash)
+    if raw_events is None:
+        return []
+
+    # substrate.create_scale_object without a block hash would switch back to the head runtime
+    metadata = substrate.metadata
+
+    def create_scale_object(type_string, data):
+        return substrate.runtime_config.create_scale_object(type_string, data=data, metadata=metadata)
+
+    layout = get_event_layout(substrate) if event_filter is not None else None
+    if layout is None:
+        storage_function = metadata.get_metadata_pallet("System").get_storage_function("Events")
+        events = create_scale_object(
+            storage_function.get_value_type_string(), data=ScaleBytes(raw_events)
+        )
+        events.decode()
+        for (i, e) in enumerate(events.value):
+            e["record_index"] = i
+        return [
+            e for e in events.value
+            if event_filter is None
+            or event_filter.matches(e["event"]["module_id"], e["event"]["event_id"])
+        ]
+
+    data = ScaleBytes(raw_events)
+    count = create_scale_object("Compact<u32>", data=data).decode(check_remaining=False)
+
+    events = []
+    for i in range(count):
+        start = data.offset
+        # Phase::ApplyExtrinsic(u32) is variant 0, Finalization and Initialization have no data
+        event_offset = start + (5 if data.data[start] == 0 else 1)
+        key = (data.data[event_offset], data.data[event_offset + 1])
+        (module_id, event_id) = layout.names[key]
+
+        if event_filter.matches(module_id, event_id):
+            record = create_scale_object(layout.record_type, data=data)
+            record.decode(check_remaining=False)
+            events.append({**record.value, "record_index": i})
+            continue
+
+        size = layout.field_sizes[key]
+        if size is None:
+            create_scale_object(layout.record_type, data=data).decode(
+                check_remaining=False
+            )
+            continue
+
+        # Skip the fields, then the topics
+        data.offset = event_offset + 2 + size
+        topics = create_scale_object("Compact<u32>", data=data).decode(
+            check_remaining=False
+        )
+        data.offset += 32 * topics
+
+    return events
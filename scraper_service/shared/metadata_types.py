@@ -0,0 +1,216 @@
+import logging
+import threading
+
+PRIMITIVE_COLUMN_TYPES = {
+    "u8": "UInt8",
+    "u16": "UInt16",
+    "u32": "UInt32",
+    "u64": "UInt64",
+    "u128": "UInt128",
+    "u256": "UInt256",
+    "i8": "Int8",
+    "i16": "Int16",
+    "i32": "Int32",
+    "i64": "Int64",
+    "i128": "Int128",
+    "i256": "Int256",
+    "str": "String",
+    "char": "String",
+}
+
+
+class MetadataTypes:
+    """
+    ClickHouse column types derived from the portable type registry of one runtime.
+
+    Decoded calls and events are flattened into columns by walking their values. `leaf_types`
+    walks a value the same way alongside its type definition and returns the column type of every
+    leaf, or None where the definition doesn't say more than the value does.
+
+    Types are described either as ("id", type_id) or as ("fields", fields) for the fields of a
+    call, an event or an enum variant.
+    """
+
+    def __init__(self, metadata):
+        self.types = {t["id"]: t["type"] for t in metadata["types"]["types"]}
+        self.calls = {}
+        self.events = {}
+
+        for pallet in metadata["pallets"]:
+            if pallet["calls"] is not None:
+                for variant in self.types[pallet["calls"]["ty"]]["def"]["variant"]["variants"]:
+                    self.calls[(pallet["name"], variant["name"])] = variant["fields"]
+            if pallet["event"] is not None:
+                for variant in self.types[pallet["event"]["ty"]]["def"]["variant"]["variants"]:
+                    self.events[(pallet["name"], variant["name"])] = variant["fields"]
+
+    def call_arg_types(self, call_module, call_function):
+        """
+        Returns {arg name: type} for a call, or None if the runtime has no such call.
+        """
+        fields = self.calls.get((call_module, call_function))
+        if fields is None:
+            return None
+        return {field["name"]: ("id", field["type"]) for field in fields}
+
+    def event_type(self, module_id, event_id):
+        fields = self.events.get((module_id, event_id))
+        if fields is None:
+            return None
+        return ("fields", fields)
+
+    def leaf_types(self, value, type_desc):
+        """
+        Column types of the leaves of `value` in the order they are flattened, skipping None
+        leaves like the flatteners do.
+        """
+        leaf_types = []
+        self._walk(value, type_desc, leaf_types)
+        return leaf_types
+
+    def _walk(self, value, type_desc, leaf_types):
+        if value is None:
+            return
+        type_desc = self._resolve(type_desc, value)
+        if isinstance(value, dict):
+            for key, child in value.items():
+                self._walk(child, self._child(type_desc, key), leaf_types)
+        elif isinstance(value, tuple):
+            for i, child in enumerate(value):
+                self._walk(child, self._child(type_desc, i), leaf_types)
+        else:
+            leaf_types.append(self._leaf_type(type_desc, value))
+
+    def _resolve(self, type_desc, value):
+        """
+        Unwraps the types that don't add a level to the decoded value: compacts, Option::Some,
+        and composites with a single unnamed field such as AccountId32 or BoundedVec.
+        """
+        while type_desc is not None:
+            (kind, definition) = type_desc
+            if kind == "fields":
+                if len(definition) == 1 and definition[0]["name"] is None:
+                    type_desc = ("id", definition[0]["type"])
+                    continue
+                return type_desc
+
+            type_info = self.types[definition]
+            type_def = type_info["def"]
+            if "compact" in type_def:
+                type_desc = ("id", type_def["compact"]["type"])
+            elif "composite" in type_def:
+                type_desc = ("fields", type_def["composite"]["fields"])
+            elif "variant" in type_def and type_info["path"] == ["Option"] and value is not None:
+                some = [v for v in type_def["variant"]["variants"] if v["name"] == "Some"]
+                type_desc = ("id", some[0]["fields"][0]["type"])
+            else:
+                return type_desc
+        return None
+
+    def _child(self, type_desc, key):
+        if type_desc is None:
+            return None
+        (kind, definition) = type_desc
+        if kind == "fields":
+            if isinstance(key, int):
+                if key < len(definition) and definition[key]["name"] is None:
+                    return ("id", definition[key]["type"])
+                return None
+            for field in definition:
+                if field["name"] == key:
+                    return ("id", field["type"])
+            return None
+
+        type_def = self.types[definition]["def"]
+        if "tuple" in type_def and isinstance(key, int) and key < len(type_def["tuple"]):
+            return ("id", type_def["tuple"][key])
+        if "variant" in type_def and isinstance(key, str):
+            for variant in type_def["variant"]["variants"]:
+                if variant["name"] == key:
+                    return ("fields", variant["fields"])
+        return None
+
+    def _leaf_type(self, type_desc, value):
+        if type_desc is None or type_desc[0] != "id":
+            return None
+        type_def = self.types[type_desc[1]]["def"]
+
+        if "primitive" in type_def:
+            column_type = PRIMITIVE_COLUMN_TYPES.get(type_def["primitive"])
+            # Bools are ints in Python, leave them to the value based guess
+            if column_type == "String" and isinstance(value, str):
+                return column_type
+            if column_type is not None and isinstance(value, int) and not isinstance(value, bool):
+                return column_type
+            return None
+
+        if "variant" in type_def and isinstance(value, str):
+            # Enum variant names, e.g. Pays::Yes
+            return "LowCardinality(String)"
+
+        if "array" in type_def and isinstance(value, str):
+            # Fixed size byte arrays are hex encoded, except account ids which are SS58 encoded
+            if value.startswith("0x") and len(value) == 2 + 2 * type_def["array"]["len"]:
+                return f"FixedString({len(value)})"
+            return "String"
+
+        if ("sequence" in type_def or "array" in type_def) and isinstance(value, list):
+            item_type = type_def["sequence" if "sequence" in type_def else "array"]["type"]
+            item_column_type = self._item_type(("id", item_type), value)
+            if item_column_type is not None:
+                return f"Array({item_column_type})"
+            # Nested structures are stored as JSON
+            return "String"
+
+        if "sequence" in type_def and isinstance(value, str):
+            # Vec<u8> decodes to a string
+            return "String"
+
+        return None
+
+    def _item_type(self, type_desc, items):
+        """
+        Column type of the items of a list if they are scalars, which also types empty lists.
+        """
+        type_desc = self._resolve(type_desc, items[0] if items else 0)
+        if type_desc is None or type_desc[0] != "id":
+            return None
+        type_def = self.types[type_desc[1]]["def"]
+
+        if "primitive" in type_def:
+            column_type = PRIMITIVE_COLUMN_TYPES.get(type_def["primitive"])
+            if column_type == "String" or all(isinstance(x, int) and not isinstance(x, bool) for x in items):
+                return column_type
+            return None
+
+        # Account ids, hashes, byte strings and enum names decode to strings
+        is_byte_array = "array" in type_def and self._is_u8(type_def["array"]["type"])
+        is_byte_sequence = "sequence" in type_def and self._is_u8(type_def["sequence"]["type"])
+        is_enum = "variant" in type_def and all(len(v["fields"]) == 0 for v in type_def["variant"]["variants"])
+        if (is_byte_array or is_byte_sequence or is_enum) and all(isinstance(x, str) for x in items):
+            return "String"
+        return None
+
+    def _is_u8(self, type_id):
+        return self.types[type_id]["def"].get("primitive") == "u8"
+
+
+metadata_types = {}
+metadata_types_lock = threading.Lock()
+
+
+def get_metadata_types(substrate):
+    """
+    Returns the MetadataTypes of the runtime substrate is currently initialised with, cached per
+    spec_version, or None if the runtime has no portable type registry (metadata before V14).
+    """
+    spec_version = substrate.runtime_version
+    with metadata_types_lock:
+        if spec_version not in metadata_types:
+            try:
+                versioned = substrate.metadata.value[1]
+                metadata_types[spec_version] = MetadataTypes(next(iter(versioned.values())))
+            except Exception as e:
+                logging.warning(f"Cannot derive column types for spec version {spec_version}: {str(e)}")
+                metadata_types[spec_version] = None
+        return metadata_types[spec_version]
@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+import logging
+
+
+class EndpointStats:
+    """Rolling health information for a single archive node endpoint."""
+
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.error_rate = 0.0
+        self.consecutive_errors = 0
+        self.last_error_at = 0.0
+        self.clients = 0
+
+    def is_healthy(self, cooldown):
+        if self.consecutive_errors == 0:
+            return True
+        # Back off exponentially while an endpoint keeps failing
+        backoff = cooldown * (2 ** min(self.consecutive_errors - 1, 5))
+        return time.monotonic() - self.last_error_at > backoff
+
+    def score(self):
+        """
+        Lower is better. Endpoints without samples yet get a neutral score so they are tried,
+        and every client already bound to an endpoint makes it less attractive.
+        """
+        latency = self.latency if self.latency is not None else 0.05
+        return latency * (1 + self.error_rate * 10) * (1 + self.clients)
+
+
+class ArchiveNodePool:
+    """
+    Picks archive node endpoints for substrate clients based on observed latency and errors.
+
+    Every thread holds its own substrate client, so clients are spread across the healthy
+    endpoints. When a request fails, the client is moved to the next best endpoint.
+    """
+
+    EWMA_ALPHA = 0.2
+    ERROR_COOLDOWN = 10
+
+    def __init__(self, urls):
+        if not urls:
+            raise ValueError("At least one archive node URL is required")
+        self.endpoints = {url: EndpointStats(url) for url in urls}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def acquire(self, exclude=()):
+        """
+        Returns the best endpoint URL and counts a client against it. Endpoints in `exclude` are
+        only used if nothing else is available.
+        """
+        with self.lock:
+            candidates = [
+                s for s in self.endpoints.values()
+                if s.url not in exclude and s.is_healthy(self.ERROR_COOLDOWN)
+            ]
+            if not candidates:
+                candidates = [s for s in self.endpoints.values() if s.url not in exclude]
+            if not candidates:
+                candidates = list(self.endpoints.values())
+
+            best = min(candidates, key=lambda s: s.score())
+            best.clients += 1
+            return best.url
+
+    def release(self, url):
+        with self.lock:
+            stats = self.endpoints.get(url)
+            if stats is not None and stats.clients > 0:
+                stats.clients -= 1
+
+    def record_success(self, url, latency):
+        with self.lock:
+            stats = self.endpoints.get(url)
+            if stats is None:
+                return
+            if stats.latency is None:
+                stats.latency = latency
+            else:
+                stats.latency += self.EWMA_ALPHA * (latency - stats.latency)
+            stats.error_rate *= 1 - self.EWMA_ALPHA
+            stats.consecutive_errors = 0
+
+    def record_failure(self, url):
+        with self.lock:
+            stats = self.endpoints.get(url)
+            if stats is None:
+                return
+            stats.error_rate += self.EWMA_ALPHA * (1 - stats.error_rate)
+            stats.consecutive_errors += 1
+            stats.last_error_at = time.monotonic()
+        logging.warning(f"Archive node {url} failed ({stats.consecutive_errors} consecutive errors)")
+
+    def summary(self):
+        with self.lock:
+            return [
+                (s.url, s.latency, s.error_rate, s.clients)
+                for s in self.endpoints.values()
+            ]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_archive_node_urls():
+    """
+    Archive nodes are configured with a comma separated SUBSTRATE_ARCHIVE_NODE_URLS, falling back
+    to the single SUBSTRATE_ARCHIVE_NODE_URL.
+    """
+    urls = os.getenv("SUBSTRATE_ARCHIVE_NODE_URLS", "")
+    urls = [url.strip() for url in urls.split(",") if url.strip()]
+    if not urls:
+        urls = [os.getenv("SUBSTRATE_ARCHIVE_NODE_URL")]
+    return urls
+
+
+def get_node_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ArchiveNodePool(get_archive_node_urls())
+        return _pool
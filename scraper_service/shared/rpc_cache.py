@@ -0,0 +1,156 @@
+import os
+import json
+import zlib
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+# Position of the block hash in the params of RPC methods whose response is fully determined by
+# that hash. State at a given block hash never changes, so these are safe to cache forever.
+BLOCK_HASH_PARAM_INDEX = {
+    "chain_getBlock": 0,
+    "chain_getHeader": 0,
+    "state_getMetadata": 0,
+    "state_getRuntimeVersion": 0,
+    "chain_getRuntimeVersion": 0,
+    "state_getStorage": 1,
+    "state_getStorageAt": 1,
+    "state_getStorageHash": 1,
+    "state_getStorageSize": 1,
+    "state_queryStorageAt": 1,
+    "state_getReadProof": 1,
+    "state_call": 2,
+    "state_getKeysPaged": 3,
+}
+
+# Only block numbers at or below the finalized head have an immutable hash
+finalized_block_number = -1
+
+
+def mark_finalized(block_number):
+    global finalized_block_number
+    finalized_block_number = max(finalized_block_number, block_number)
+
+
+def is_cacheable(method, params):
+    if method == "chain_getBlockHash":
+        return (
+            len(params) == 1
+            and isinstance(params[0], int)
+            and params[0] <= finalized_block_number
+        )
+
+    index = BLOCK_HASH_PARAM_INDEX.get(method)
+    return index is not None and len(params) > index and params[index] is not None
+
+
+class RpcCache:
+    """
+    Size bounded on-disk cache of RPC results, keyed by a hash of the method and its params.
+
+    Entries are zlib compressed JSON stored in SQLite, so several shovel containers can share the
+    cache through a volume. The least recently used entries are evicted once the cache grows past
+    `max_bytes`.
+    """
+
+    EVICT_TO_RATIO = 0.9
+
+    def __init__(self, directory, max_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            os.path.join(directory, "rpc_cache.sqlite3"),
+            check_same_thread=False,
+            timeout=60,
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key BLOB PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def make_key(method, params):
+        return hashlib.sha256(
+            json.dumps([method, params], separators=(",", ":")).encode()
+        ).digest()
+
+    def get(self, method, params):
+        key = self.make_key(method, params)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            self.db.commit()
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, method, params, result):
+        key = self.make_key(method, params)
+        value = zlib.compress(json.dumps(result, separators=(",", ":")).encode())
+        with self.lock:
+            previous = self.db.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            self.size += len(value) - (previous[0] if previous else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        target = self.max_bytes * self.EVICT_TO_RATIO
+        evicted = 0
+        while self.size > target:
+            rows = self.db.execute(
+                "SELECT key, size FROM entries ORDER BY accessed ASC LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self.size = 0
+                break
+            keys = []
+            for (key, size) in rows:
+                if self.size <= target:
+                    break
+                keys.append((key,))
+                self.size -= size
+            self.db.executemany("DELETE FROM entries WHERE key = ?", keys)
+            evicted += len(keys)
+        logging.info(f"Evicted {evicted} entries from the RPC cache")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_rpc_cache():
+    """
+    Returns the shared RPC cache, or None if SUBSTRATE_RPC_CACHE_DIR is not set.
+    """
+    global _cache
+    directory = os.getenv("SUBSTRATE_RPC_CACHE_DIR")
+    if not directory:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            max_bytes = int(os.getenv("SUBSTRATE_RPC_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+            _cache = RpcCache(directory, max_bytes)
+        return _cache
@@ -0,0 +1,150 @@
+import os
+import re
+import zlib
+import logging
+import threading
+from scalecodec.base import ScaleBytes
+
+METADATA_KEY_PATTERN = re.compile(r"^METADATA_(\d+)$")
+METADATA_FILE_PATTERN = re.compile(r"^metadata_(\d+)\.scale\.zlib$")
+
+
+class MetadataStore:
+    """
+    Raw SCALE encoded runtime metadata keyed by spec_version, persisted in a directory that can
+    be shared between shovel containers. Everything on disk is preloaded at startup.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.raw = {}
+
+        for filename in os.listdir(directory):
+            match = METADATA_FILE_PATTERN.match(filename)
+            if match:
+                with open(os.path.join(directory, filename), "rb") as f:
+                    self.raw[int(match.group(1))] = zlib.decompress(f.read())
+        logging.info(f"Preloaded runtime metadata for {len(self.raw)} spec versions")
+
+    def get(self, spec_version):
+        with self.lock:
+            if spec_version not in self.raw:
+                self._load(spec_version)
+            return self.raw.get(spec_version)
+
+    def set(self, spec_version, raw):
+        with self.lock:
+            if spec_version in self.raw:
+                return
+            self.raw[spec_version] = raw
+            path = os.path.join(self.directory, f"metadata_{spec_version}.scale.zlib")
+            # Write atomically, other containers may be reading the same directory
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(zlib.compress(raw))
+            os.replace(tmp_path, path)
+
+    def _load(self, spec_version):
+        # Another container may have written it since we started
+        path = os.path.join(self.directory, f"metadata_{spec_version}.scale.zlib")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self.raw[spec_version] = zlib.decompress(f.read())
+
+
+class MetadataCacheRegion:
+    """
+    Implements the `get`/`set` interface SubstrateInterface expects from its `cache_region`, which
+    it consults with `METADATA_<spec_version>` keys whenever the runtime changes.
+    """
+
+    def __init__(self, store, substrate):
+        self.store = store
+        self.substrate = substrate
+
+    def get(self, key):
+        match = METADATA_KEY_PATTERN.match(key)
+        if not match:
+            return None
+        raw = self.store.get(int(match.group(1)))
+        if raw is None:
+            return None
+
+        metadata = self.substrate.runtime_config.create_scale_object(
+            "MetadataVersioned", data=ScaleBytes(raw)
+        )
+        metadata.decode()
+        return metadata
+
+    def set(self, key, value):
+        match = METADATA_KEY_PATTERN.match(key)
+        if match and value is not None and value.data is not None:
+            self.store.set(int(match.group(1)), bytes(value.data.data))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_metadata_store():
+    """
+    Returns the shared metadata store, or None if SUBSTRATE_METADATA_CACHE_DIR is not set.
+    """
+    global _store
+    directory = os.getenv("SUBSTRATE_METADATA_CACHE_DIR")
+    if not directory:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = MetadataStore(directory)
+        return _store
+
+
+def get_spec_version(substrate, block_number):
+    block_hash = substrate.get_block_hash(block_number)
+    return substrate.rpc_request("state_getRuntimeVersion", [block_hash])["result"]["specVersion"]
+
+
+def find_runtime_upgrades(substrate, start, end):
+    """
+    Returns [(block_number, spec_version)] for the first block of every runtime seen between
+    start and end, by bisecting on the runtime version. Spec versions only ever increase, so a
+    range with the same version at both ends contains no upgrade.
+    """
+    upgrades = [(start, get_spec_version(substrate, start))]
+    end_spec_version = get_spec_version(substrate, end)
+
+    def bisect(lo, lo_spec_version, hi, hi_spec_version):
+        if lo_spec_version == hi_spec_version:
+            return
+        if hi - lo == 1:
+            upgrades.append((hi, hi_spec_version))
+            return
+        mid = (lo + hi) // 2
+        mid_spec_version = get_spec_version(substrate, mid)
+        bisect(lo, lo_spec_version, mid, mid_spec_version)
+        bisect(mid, mid_spec_version, hi, hi_spec_version)
+
+    bisect(start, upgrades[0][1], end, end_spec_version)
+    return upgrades
+
+
+def warm_runtime_metadata(substrate, start, end):
+    """
+    Makes sure the metadata of every runtime between start and end is in the metadata store, so
+    decoding those blocks later never fetches metadata from the node.
+    """
+    store = get_metadata_store()
+    if store is None or end <= start:
+        return
+
+    upgrades = find_runtime_upgrades(substrate, start, end)
+    logging.info(f"Found {len(upgrades)} runtimes between blocks {start} and {end}")
+    for (block_number, spec_version) in upgrades:
+        if store.get(spec_version) is not None:
+            continue
+        logging.info(f"Caching metadata for spec version {spec_version}")
+        # Blocks are decoded with the runtime of their parent
+        substrate.init_runtime(block_hash=substrate.get_block_hash(min(block_number + 1, end)))
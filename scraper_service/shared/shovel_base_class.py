@@ -1,4 +1,5 @@
 from shared.clickhouse.batch_insert import buffer_insert, flush_buffer, batch_insert_into_clickhouse_table
+from shared.block_prefetcher import BlockPrefetcher
 from shared.substrate import get_substrate_client, reconnect_substrate
 from time import sleep
 from shared.clickhouse.utils import (
@@ -6,6 +7,9 @@ from shared.clickhouse.utils import (
     table_exists,
 )
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
+from shared.rpc_cache import mark_finalized
+from shared.runtime_metadata import warm_runtime_metadata
+from shared.state_snapshots import load_state_snapshot, save_state_snapshot
 from tqdm import tqdm
 import logging
 import threading
@@ -18,6 +22,14 @@ class ShovelBaseClass:
     last_buffer_flush_call_block_number = 0
     name = None
     skip_interval = 1
+    # Set when several shovels share a process, otherwise the process wide buffer is used
+    insert_buffer = None
+    # Threads running prefetch_block for upcoming blocks, 0 disables prefetching
+    prefetch_workers = 0
+    prefetcher = None
+    # Blocks between persisted snapshots of get_state(), 0 disables state snapshots
+    snapshot_interval = 0
+    last_state_snapshot_block_number = 0
     MAX_RETRIES = 3
     RETRY_DELAY = 5
 
@@ -39,18 +51,13 @@ class ShovelBaseClass:
                 print("Fetching the finalized block")
                 finalized_block_hash = substrate.get_chain_finalised_head()
                 finalized_block_number = substrate.get_block_number(finalized_block_hash)
+                mark_finalized(finalized_block_number)
 
                 # Start the clickhouse buffer
                 print("Starting Clickhouse buffer")
-                executor = ThreadPoolExecutor(max_workers=1)
-                buffer_thread = threading.Thread(
-                    target=flush_buffer,
-                    args=(executor, self._buffer_flush_started, self._buffer_flush_done),
-                    daemon=True  # Make it a daemon thread so it exits with the main thread
-                )
-                buffer_thread.start()
-
-                last_scraped_block_number = self.get_checkpoint()
+                self.start_buffer_flush()
+
+                last_scraped_block_number = self.restore_state(self.get_checkpoint())
                 logging.info(f"Last scraped block is {last_scraped_block_number}")
 
                 # Create a list of block numbers to scrape
@@ -63,17 +70,13 @@ class ShovelBaseClass:
                         ))
 
                         if len(block_numbers) > 0:
+                            try:
+                                warm_runtime_metadata(substrate, block_numbers[0], block_numbers[-1])
+                            except Exception as e:
+                                logging.warning(f"Failed to warm runtime metadata cache: {str(e)}")
+
                             logging.info(f"Catching up {len(block_numbers)} blocks")
-                            for block_number in tqdm(block_numbers):
-                                try:
-                                    self.process_block(block_number)
-                                    self.checkpoint_block_number = block_number
-                                except DatabaseConnectionError as e:
-                                    logging.error(f"Database connection error while processing block {block_number}: {str(e)}")
-                                    raise  # Re-raise to be caught by outer try-except
-                                except Exception as e:
-                                    logging.error(f"Fatal error while processing block {block_number}: {str(e)}")
-                                    raise ShovelProcessingError(f"Failed to process block {block_number}: {str(e)}")
+                            self.process_blocks(block_numbers)
                         else:
                             logging.info("Already up to latest finalized block, checking again in 12s...")
 
@@ -85,6 +88,7 @@ class ShovelBaseClass:
                         last_scraped_block_number = self.get_checkpoint()
                         finalized_block_hash = substrate.get_chain_finalised_head()
                         finalized_block_number = substrate.get_block_number(finalized_block_hash)
+                        mark_finalized(finalized_block_number)
 
                     except DatabaseConnectionError as e:
                         retry_count += 1
@@ -96,6 +100,7 @@ class ShovelBaseClass:
                         logging.info(f"Retrying in {self.RETRY_DELAY} seconds...")
                         sleep(self.RETRY_DELAY)
                         reconnect_substrate()  # Try to reconnect to substrate
+                        substrate = get_substrate_client()
                         continue
 
             except ShovelProcessingError as e:
@@ -105,11 +110,99 @@ class ShovelBaseClass:
                 logging.error(f"Unexpected error: {str(e)}")
                 sys.exit(1)
 
+    def start_buffer_flush(self):
+        """
+        Starts the thread flushing this shovel's buffer and checkpointing after each flush.
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        buffer_thread = threading.Thread(
+            target=flush_buffer,
+            args=(executor, self._buffer_flush_started, self._buffer_flush_done, self.insert_buffer),
+            daemon=True  # Make it a daemon thread so it exits with the main thread
+        )
+        buffer_thread.start()
+
+    def process_blocks(self, block_numbers):
+        """
+        Processes a range of blocks in order, advancing the checkpoint after each one.
+        """
+        total = len(block_numbers)
+        if self.prefetch_workers > 0:
+            if self.prefetcher is None:
+                self.prefetcher = BlockPrefetcher(self.prefetch_block, self.prefetch_workers)
+            block_numbers = self.prefetcher.iterate(block_numbers)
+
+        for block_number in tqdm(block_numbers, total=total):
+            try:
+                self.process_block(block_number)
+                self.snapshot_state(block_number)
+                self.checkpoint_block_number = block_number
+            except DatabaseConnectionError as e:
+                logging.error(f"Database connection error while processing block {block_number}: {str(e)}")
+                raise  # Re-raise to be caught by outer try-except
+            except Exception as e:
+                logging.error(f"Fatal error while processing block {block_number}: {str(e)}")
+                raise ShovelProcessingError(f"Failed to process block {block_number}: {str(e)}")
+
     def process_block(self, n):
         raise NotImplementedError(
             "Please implement the process_block method in your shovel class!"
         )
 
+    def prefetch_block(self, n):
+        """
+        Called on a worker thread ahead of `process_block(n)` when `prefetch_workers` is set, to
+        fetch and decode what process_block will need.
+        """
+        pass
+
+    def get_state(self):
+        """
+        Returns the in-memory state that process_block builds up from block to block, as a dict of
+        JSON serializable values, see `shared.state_snapshots`. Stateful shovels implement this and
+        `set_state` and set `snapshot_interval`.
+        """
+        return None
+
+    def set_state(self, state):
+        """
+        Restores state returned by `get_state`, before processing the block after the snapshot.
+        """
+        pass
+
+    def snapshot_state(self, block_number):
+        """
+        Persists the state after `block_number` every `snapshot_interval` blocks.
+        """
+        if self.snapshot_interval <= 0:
+            return
+        if block_number - self.last_state_snapshot_block_number < self.snapshot_interval:
+            return
+        try:
+            save_state_snapshot(self.name, block_number, self.get_state())
+        except Exception as e:
+            raise DatabaseConnectionError(f"Failed to save state snapshot: {str(e)}")
+        self.last_state_snapshot_block_number = block_number
+
+    def restore_state(self, checkpoint):
+        """
+        Restores the latest state snapshot at or below the checkpoint, returning the block to
+        resume after. Blocks between the snapshot and the checkpoint are processed again, which
+        rewrites the same rows.
+        """
+        if self.snapshot_interval <= 0:
+            return checkpoint
+        snapshot = load_state_snapshot(self.name, checkpoint)
+        if snapshot is None:
+            logging.info(f"No state snapshot for {self.name}, starting from empty state")
+            return checkpoint
+
+        (block_number, state) = snapshot
+        self.set_state(state)
+        self.last_state_snapshot_block_number = block_number
+        logging.info(f"Restored {self.name} state from block {block_number}")
+        return block_number
+
     def _buffer_flush_started(self):
         self.last_buffer_flush_call_block_number = self.checkpoint_block_number
 
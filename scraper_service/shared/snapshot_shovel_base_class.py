@@ -0,0 +1,138 @@
+import os
+import logging
+import queue
+import threading
+import contextvars
+from tqdm import tqdm
+
+from shared.clickhouse.batch_insert import buffer_insert
+from shared.clickhouse.utils import get_clickhouse_client, table_exists
+from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
+from shared.shovel_base_class import ShovelBaseClass
+from shared.substrate import close_substrate_client
+
+SNAPSHOT_DAYS_TABLE = "shovel_snapshot_days"
+
+
+class SnapshotShovelBaseClass(ShovelBaseClass):
+    """
+    Base class for shovels that write an independent snapshot every `blocks_per_snapshot` blocks,
+    such as the daily shovels. Implement `process_snapshot(n)` instead of `process_block`.
+
+    Every finished snapshot is recorded in shovel_snapshot_days. When catching up with
+    SNAPSHOT_BACKFILL_WORKERS above 1, the snapshots in the range that are not recorded yet are
+    processed concurrently, and the checkpoint advances to the highest snapshot with every
+    snapshot before it finished.
+    """
+
+    blocks_per_snapshot = 7200
+    backfill_workers = int(os.getenv("SNAPSHOT_BACKFILL_WORKERS", "1"))
+
+    def process_snapshot(self, n):
+        raise NotImplementedError(
+            "Please implement the process_snapshot method in your shovel class!"
+        )
+
+    def process_block(self, n):
+        if n % self.blocks_per_snapshot != 0:
+            return
+        self.process_snapshot(n)
+        self.mark_snapshot_finished(n)
+
+    def mark_snapshot_finished(self, n):
+        if not table_exists(SNAPSHOT_DAYS_TABLE):
+            query = f"""
+            CREATE TABLE IF NOT EXISTS {SNAPSHOT_DAYS_TABLE} (
+                shovel_name String,
+                block_number UInt64
+            ) ENGINE = ReplacingMergeTree()
+            ORDER BY (shovel_name, block_number)
+            """
+            get_clickhouse_client().execute(query)
+        buffer_insert(SNAPSHOT_DAYS_TABLE, [f"'{self.name}'", n])
+
+    def get_finished_snapshots(self, first_block_number, last_block_number):
+        if not table_exists(SNAPSHOT_DAYS_TABLE):
+            return set()
+        query = f"""
+            SELECT block_number
+            FROM {SNAPSHOT_DAYS_TABLE}
+            WHERE shovel_name = '{self.name}'
+              AND block_number BETWEEN {first_block_number} AND {last_block_number}
+        """
+        return {r[0] for r in get_clickhouse_client().execute(query)}
+
+    def close_backfill_client(self):
+        """
+        Called once on each backfill worker thread when the backfill run ends, to release the
+        substrate client the thread used. Shovels with their own client override this.
+        """
+        close_substrate_client()
+
+    def backfill_worker(self, pending, done, stop):
+        try:
+            while not stop.is_set():
+                try:
+                    n = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self.process_block(n)
+                    done.put((n, None))
+                except Exception as e:
+                    done.put((n, e))
+        finally:
+            # The worker keeps its client for the whole run and releases it when the run ends
+            self.close_backfill_client()
+
+    def process_blocks(self, block_numbers):
+        snapshot_blocks = [n for n in block_numbers if n % self.blocks_per_snapshot == 0]
+        if self.backfill_workers <= 1 or len(snapshot_blocks) <= 1:
+            return super().process_blocks(block_numbers)
+
+        try:
+            finished = self.get_finished_snapshots(block_numbers[0], block_numbers[-1])
+        except Exception as e:
+            raise DatabaseConnectionError(f"Failed to read finished snapshots: {str(e)}")
+        missing = [n for n in snapshot_blocks if n not in finished]
+        logging.info(
+            f"Backfilling {len(missing)} of {len(snapshot_blocks)} snapshots on {self.backfill_workers} workers"
+        )
+
+        pending = queue.Queue()
+        for n in missing:
+            pending.put(n)
+        done = queue.Queue()
+        stop = threading.Event()
+        # Each worker runs in its own copy of this context, so rows go to this shovel's buffer
+        workers = [
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(self.backfill_worker, pending, done, stop),
+                daemon=True,
+            )
+            for _ in range(min(self.backfill_workers, len(missing)))
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            next_snapshot = 0
+            for _ in tqdm(range(len(missing))):
+                (block_number, error) = done.get()
+                if isinstance(error, DatabaseConnectionError):
+                    logging.error(f"Database connection error while processing block {block_number}: {str(error)}")
+                    raise error
+                if error is not None:
+                    logging.error(f"Fatal error while processing block {block_number}: {str(error)}")
+                    raise ShovelProcessingError(f"Failed to process block {block_number}: {str(error)}")
+
+                finished.add(block_number)
+                while next_snapshot < len(snapshot_blocks) and snapshot_blocks[next_snapshot] in finished:
+                    self.checkpoint_block_number = snapshot_blocks[next_snapshot]
+                    next_snapshot += 1
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+        self.checkpoint_block_number = block_numbers[-1]
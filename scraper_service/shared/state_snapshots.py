@@ -0,0 +1,124 @@
+import json
+
+from shared.clickhouse.batch_insert import buffer_insert
+from shared.clickhouse.utils import get_clickhouse_client, table_exists, to_string_value
+
+SNAPSHOTS_TABLE = "shovel_state_snapshot_entries"
+
+# entry_key of the row holding a state key's value, or an empty dict whose entries follow in rows
+# of their own. The row with an empty state_key too holds the number of rows in the snapshot.
+HEADER_KEY = ""
+
+
+def create_snapshots_table():
+    if not table_exists(SNAPSHOTS_TABLE):
+        query = f"""
+        CREATE TABLE IF NOT EXISTS {SNAPSHOTS_TABLE} (
+            shovel_name LowCardinality(String),
+            block_number UInt64 CODEC(Delta, ZSTD),
+            state_key LowCardinality(String),
+            entry_key String CODEC(ZSTD),
+            value String CODEC(ZSTD)
+        ) ENGINE = ReplacingMergeTree()
+        ORDER BY (shovel_name, block_number, state_key, entry_key)
+        """
+        get_clickhouse_client().execute(query)
+
+
+def encode_json(value):
+    return json.dumps(value, separators=(",", ":"), sort_keys=True)
+
+
+def decode_key(encoded):
+    """
+    Decodes an entry key, turning the lists JSON made of tuple keys back into tuples.
+    """
+    def to_tuple(value):
+        return tuple(to_tuple(v) for v in value) if isinstance(value, list) else value
+    return to_tuple(json.loads(encoded))
+
+
+def encode_state(state):
+    """
+    Returns the (state_key, entry_key, value) rows of a state dict. Dict values are written as a
+    header row with an empty dict followed by a row per entry, so large maps are stored one entry
+    per row. Keys and values must be JSON serializable, tuples are stored as lists.
+    """
+    rows = []
+    for (state_key, value) in state.items():
+        if isinstance(value, dict):
+            rows.append((state_key, HEADER_KEY, "{}"))
+            rows.extend(
+                (state_key, encode_json(entry_key), encode_json(entry_value))
+                for (entry_key, entry_value) in value.items()
+            )
+        else:
+            rows.append((state_key, HEADER_KEY, encode_json(value)))
+    return rows
+
+
+def decode_state(rows):
+    state = {}
+    entries = []
+    for (state_key, entry_key, value) in rows:
+        if state_key == HEADER_KEY:
+            continue
+        if entry_key == HEADER_KEY:
+            state[state_key] = json.loads(value)
+        else:
+            entries.append((state_key, entry_key, value))
+    for (state_key, entry_key, value) in entries:
+        state[state_key][decode_key(entry_key)] = json.loads(value)
+    return state
+
+
+def save_state_snapshot(shovel_name, block_number, state):
+    """
+    Queues a snapshot of a shovel's state as of the end of `block_number`. It goes through the
+    shovel's buffer, so it is flushed together with the rows of the blocks before it.
+    """
+    create_snapshots_table()
+    rows = encode_state(state)
+    for (state_key, entry_key, value) in rows:
+        buffer_insert(
+            SNAPSHOTS_TABLE,
+            [f"'{shovel_name}'", block_number, to_string_value(state_key),
+             to_string_value(entry_key), to_string_value(value)]
+        )
+    buffer_insert(
+        SNAPSHOTS_TABLE,
+        [f"'{shovel_name}'", block_number, "''", "''", f"'{len(rows)}'"]
+    )
+
+
+def load_state_snapshot(shovel_name, max_block_number):
+    """
+    Returns (block_number, state) of the latest complete snapshot of a shovel at or below
+    `max_block_number`, or None if there is none. A snapshot is complete once all the rows its
+    count row announces are stored, so one cut short by a restart mid flush is skipped.
+    """
+    if not table_exists(SNAPSHOTS_TABLE):
+        return None
+    query = f"""
+        SELECT block_number
+        FROM {SNAPSHOTS_TABLE}
+        WHERE shovel_name = '{shovel_name}' AND block_number <= {int(max_block_number)}
+        GROUP BY block_number
+        HAVING uniqExact(state_key, entry_key) = 1 + toUInt64OrZero(
+            anyIf(value, state_key = '' AND entry_key = '')
+        ) AND countIf(state_key = '' AND entry_key = '') > 0
+        ORDER BY block_number DESC
+        LIMIT 1
+    """
+    res = get_clickhouse_client().execute(query)
+    if not res:
+        return None
+    block_number = res[0][0]
+
+    query = f"""
+        SELECT DISTINCT state_key, entry_key, value
+        FROM {SNAPSHOTS_TABLE}
+        WHERE shovel_name = '{shovel_name}' AND block_number = {block_number}
+    """
+    rows = get_clickhouse_client().execute_iter(query)
+    return (block_number, decode_state(rows))
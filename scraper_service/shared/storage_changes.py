@@ -0,0 +1,300 @@
+import hashlib
+from substrateinterface.utils.hasher import xxh128
+
+from shared.substrate import get_substrate_client
+
+# Keys per state_getKeysPaged page and state_queryStorageAt request
+PAGE_SIZE = 1000
+# Keys per state_getReadProof request
+PROOF_KEYS = 256
+
+
+def blake2_256(data):
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+
+def storage_prefix(pallet, storage_function):
+    """
+    Returns the 0x prefix of every key of a storage item, twox128(pallet) ++ twox128(storage).
+    """
+    return "0x" + (xxh128(pallet.encode()) + xxh128(storage_function.encode())).hex()
+
+
+# Owner, hotkey -> coldkey, read by the hotkey owner map and subnets shovels
+OWNER_PREFIX = storage_prefix("SubtensorModule", "Owner")
+
+
+def decode_compact(data, i):
+    """
+    Decodes a SCALE compact integer at offset i, returning (value, next offset).
+    """
+    mode = data[i] & 0b11
+    if mode == 0:
+        return (data[i] >> 2, i + 1)
+    if mode == 1:
+        return (int.from_bytes(data[i:i + 2], "little") >> 2, i + 2)
+    if mode == 2:
+        return (int.from_bytes(data[i:i + 4], "little") >> 2, i + 4)
+    length = (data[i] >> 2) + 4
+    return (int.from_bytes(data[i + 1:i + 1 + length], "little"), i + 1 + length)
+
+
+def decode_node(data):
+    """
+    Decodes a node of the substrate state trie, returning (partial key nibbles, children). For a
+    branch, children is a list of 16 child references, each a 32 byte hash, the encoding of an
+    inline node or None. For a leaf or the empty trie it is None.
+    """
+    first = data[0]
+    if first == 0:
+        return ((), None)
+    if first >> 6 == 0b01:
+        (is_branch, value_kind, size_bits) = (False, "inline", 6)
+    elif first >> 6 == 0b10:
+        (is_branch, value_kind, size_bits) = (True, None, 6)
+    elif first >> 6 == 0b11:
+        (is_branch, value_kind, size_bits) = (True, "inline", 6)
+    elif first >> 5 == 0b001:
+        (is_branch, value_kind, size_bits) = (False, "hashed", 5)
+    elif first >> 4 == 0b0001:
+        (is_branch, value_kind, size_bits) = (True, "hashed", 4)
+    else:
+        raise ValueError(f"Unknown trie node header {first:#04x}")
+
+    # Partial key length in nibbles, continued in the following bytes when saturated
+    mask = (1 << size_bits) - 1
+    nibble_count = first & mask
+    i = 1
+    if nibble_count == mask:
+        while True:
+            nibble_count += data[i]
+            i += 1
+            if data[i - 1] < 255:
+                break
+
+    # Odd partial keys are padded with a zero nibble at the front
+    partial_bytes = data[i:i + (nibble_count + 1) // 2]
+    i += len(partial_bytes)
+    nibbles = []
+    for b in partial_bytes:
+        nibbles.extend((b >> 4, b & 0x0f))
+    partial = tuple(nibbles[len(nibbles) - nibble_count:])
+
+    if not is_branch:
+        return (partial, None)
+
+    bitmap = int.from_bytes(data[i:i + 2], "little")
+    i += 2
+    if value_kind == "hashed":
+        i += 32
+    elif value_kind == "inline":
+        (length, i) = decode_compact(data, i)
+        i += length
+
+    children = [None] * 16
+    for nibble in range(16):
+        if bitmap & (1 << nibble):
+            (length, i) = decode_compact(data, i)
+            children[nibble] = bytes(data[i:i + length])
+            i += length
+    return (partial, children)
+
+
+def to_nibbles(data):
+    nibbles = []
+    for b in data:
+        nibbles.extend((b >> 4, b & 0x0f))
+    return tuple(nibbles)
+
+
+def from_nibbles(nibbles):
+    """
+    Packs nibbles into bytes, padding an odd count with a trailing zero nibble.
+    """
+    if len(nibbles) % 2:
+        nibbles = tuple(nibbles) + (0,)
+    return bytes((nibbles[i] << 4) | nibbles[i + 1] for i in range(0, len(nibbles), 2))
+
+
+def subtrie_refs(nodes, root, nibbles):
+    """
+    Returns {nibble: child reference} for the subtries directly below the key path `nibbles`, using
+    trie nodes from a read proof of any key starting with that path. A reference changes if and
+    only if something below it changed.
+
+    When the path ends inside the partial key of a node, all keys below the path are in that node,
+    which is returned as the only child.
+    """
+    ref = root
+    depth = 0
+    while True:
+        data = nodes.get(ref) if len(ref) == 32 else ref
+        if data is None:
+            raise ValueError(f"Read proof is missing trie node 0x{ref.hex()}")
+        (partial, children) = decode_node(data)
+        remaining = nibbles[depth:]
+
+        if len(remaining) <= len(partial):
+            if partial[:len(remaining)] != remaining:
+                return {}
+            if len(remaining) < len(partial):
+                return {partial[len(remaining)]: ref}
+            if children is None:
+                return {}
+            return {nibble: child for nibble, child in enumerate(children) if child is not None}
+
+        if partial != remaining[:len(partial)] or children is None:
+            return {}
+        depth += len(partial)
+        ref = children[nibbles[depth]]
+        depth += 1
+        if ref is None:
+            return {}
+
+
+def subtrie_ref(nodes, root, nibbles):
+    """
+    Returns the reference of the trie node holding every key that starts with the path `nibbles`,
+    including a value at the path itself, or None if there is none. It changes if and only if
+    something at or below the path changed.
+    """
+    ref = root
+    depth = 0
+    while True:
+        data = nodes.get(ref) if len(ref) == 32 else ref
+        if data is None:
+            raise ValueError(f"Read proof is missing trie node 0x{ref.hex()}")
+        (partial, children) = decode_node(data)
+        remaining = nibbles[depth:]
+
+        if len(remaining) <= len(partial):
+            return ref if partial[:len(remaining)] == remaining else None
+        if partial != remaining[:len(partial)] or children is None:
+            return None
+        depth += len(partial)
+        ref = children[nibbles[depth]]
+        depth += 1
+        if ref is None:
+            return None
+
+
+def fetch_proof_nodes(block_hash, keys):
+    """
+    Returns {hash: encoded node} of the trie nodes in the read proofs of `keys`, 0x hex strings.
+    """
+    substrate = get_substrate_client()
+    nodes = {}
+    for i in range(0, len(keys), PROOF_KEYS):
+        proof = substrate.rpc_request(
+            "state_getReadProof", [keys[i:i + PROOF_KEYS], block_hash]
+        )["result"]["proof"]
+        for node in proof:
+            data = bytes.fromhex(node[2:])
+            nodes[blake2_256(data)] = data
+    return nodes
+
+
+def get_state_root(block_hash):
+    header = get_substrate_client().rpc_request("chain_getHeader", [block_hash])["result"]
+    return bytes.fromhex(header["stateRoot"][2:])
+
+
+class StoragePrefixTracker:
+    """
+    Tracks every key and value under a storage prefix, e.g. a storage map, from block to block.
+
+    The keys are split into shards by the `shard_depth` bytes following the prefix. Each update
+    compares the trie nodes on the way down to the shards with those of the previous update, using
+    read proofs of a few keys rather than of the whole map, and only lists and reads the shards
+    below a changed node. The first update reads the whole map.
+    """
+
+    def __init__(self, prefix, shard_depth=1):
+        self.prefix = bytes.fromhex(prefix[2:] if prefix.startswith("0x") else prefix)
+        self.prefix_nibbles = to_nibbles(self.prefix)
+        self.shard_depth = shard_depth
+        self.state_root = None
+        # Child references of the visited trie nodes, by nibble path below the prefix
+        self.refs = {}
+        # {key: value} of every shard, by nibble path below the prefix, as 0x hex strings
+        self.shards = {}
+
+    @property
+    def values(self):
+        """
+        Iterates (key, value) over every entry under the prefix as of the last update.
+        """
+        for shard in self.shards.values():
+            yield from shard.items()
+
+    def update(self, block_hash):
+        """
+        Brings the tracker to `block_hash`, returning {key: value} for every key that was added or
+        changed since the previous update and {key: None} for every removed key.
+        """
+        state_root = get_state_root(block_hash)
+        if state_root == self.state_root:
+            return {}
+
+        changes = {}
+        frontier = [()]
+        while frontier:
+            nodes = fetch_proof_nodes(block_hash, [
+                "0x" + (self.prefix + from_nibbles(path)).hex() for path in frontier
+            ])
+            next_frontier = []
+            for path in frontier:
+                refs = subtrie_refs(nodes, state_root, self.prefix_nibbles + path)
+                previous = self.refs.get(path, {})
+                if refs:
+                    self.refs[path] = refs
+                else:
+                    self.refs.pop(path, None)
+
+                for nibble in set(refs) | set(previous):
+                    if refs.get(nibble) == previous.get(nibble):
+                        continue
+                    child = path + (nibble,)
+                    if len(child) < 2 * self.shard_depth:
+                        next_frontier.append(child)
+                    else:
+                        changes.update(self.read_shard(block_hash, child, exists=nibble in refs))
+            frontier = next_frontier
+
+        self.state_root = state_root
+        return changes
+
+    def read_shard(self, block_hash, path, exists=True):
+        """
+        Lists and reads every key of a shard, returning the changes against the previous read.
+        """
+        previous = self.shards.pop(path, {})
+        current = {}
+        if exists:
+            substrate = get_substrate_client()
+            shard_prefix = "0x" + (self.prefix + from_nibbles(path)).hex()
+            start_key = None
+            while True:
+                keys = substrate.rpc_request(
+                    "state_getKeysPaged", [shard_prefix, PAGE_SIZE, start_key, block_hash]
+                )["result"]
+                if keys:
+                    result = substrate.rpc_request(
+                        "state_queryStorageAt", [keys, block_hash]
+                    )["result"]
+                    for change_set in result:
+                        for (key, value) in change_set["changes"]:
+                            if value is not None:
+                                current[key] = value
+                if len(keys) < PAGE_SIZE:
+                    break
+                start_key = keys[-1]
+
+        if current:
+            self.shards[path] = current
+
+        changes = {key: value for key, value in current.items() if previous.get(key) != value}
+        for key in previous:
+            if key not in current:
+                changes[key] = None
+        return changes
@@ -1,25 +1,340 @@
 import os
+import time
+import queue
+import asyncio
+import logging
 from functools import lru_cache
+from async_substrate_interface import AsyncSubstrateInterface
 from substrateinterface import SubstrateInterface
+from substrateinterface.exceptions import SubstrateRequestException, StorageFunctionNotFound
+from substrateinterface.storage import StorageKey
 import threading
 
+from shared.node_pool import get_node_pool
+from shared.rpc_cache import get_rpc_cache, is_cacheable
+from shared.runtime_metadata import MetadataCacheRegion, get_metadata_store
+
 thread_local = threading.local()
 
+QUERY_MAP_WORKERS = int(os.getenv("QUERY_MAP_WORKERS", "16"))
+
+
+class PooledSubstrateInterface(SubstrateInterface):
+    """
+    SubstrateInterface bound to an endpoint of the archive node pool.
+
+    Every RPC is timed and reported to the pool. If an endpoint fails, the request is retried on
+    the next best endpoint so the block currently being processed is not lost.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        url = pool.acquire()
+        failed = set()
+        while True:
+            try:
+                super().__init__(url)
+                self.released = False
+                break
+            except Exception as e:
+                pool.record_failure(url)
+                pool.release(url)
+                failed.add(url)
+                # Fail once every endpoint was tried, so the container restarts
+                if len(failed) >= len(pool):
+                    raise e
+                url = pool.acquire(exclude=failed)
+
+        # Runtime metadata is looked up by spec_version in the shared store before asking the node
+        store = get_metadata_store()
+        if store is not None:
+            self.cache_region = MetadataCacheRegion(store, self)
+
+    def rpc_request(self, method, params, result_handler=None):
+        cache = get_rpc_cache() if result_handler is None else None
+        if cache is not None and is_cacheable(method, params):
+            result = cache.get(method, params)
+            if result is not None:
+                return {"jsonrpc": "2.0", "result": result, "id": None}
+
+            response = self._pooled_rpc_request(method, params, result_handler)
+            if response.get("result") is not None and "error" not in response:
+                cache.set(method, params, response["result"])
+            return response
+
+        return self._pooled_rpc_request(method, params, result_handler)
+
+    def _pooled_rpc_request(self, method, params, result_handler):
+        failed = set()
+        while True:
+            url = self.url
+            start = time.monotonic()
+            try:
+                result = super().rpc_request(method, params, result_handler)
+            except SubstrateRequestException:
+                # The node answered, the request itself was bad
+                self.pool.record_success(url, time.monotonic() - start)
+                raise
+            except Exception as e:
+                self.pool.record_failure(url)
+                failed.add(url)
+                if len(failed) >= len(self.pool):
+                    raise e
+                self._failover(exclude=failed)
+                continue
+
+            self.pool.record_success(url, time.monotonic() - start)
+            return result
+
+    def _failover(self, exclude):
+        previous = self.url
+        self.url = self.pool.acquire(exclude=exclude)
+        self.pool.release(previous)
+        logging.info(f"Failing over from {previous} to {self.url}")
+        self.connect_websocket()
+
+    def close(self):
+        if not getattr(self, "released", True):
+            self.pool.release(self.url)
+            self.released = True
+        super().close()
+
 
 def get_substrate_client():
     if not hasattr(thread_local, "client"):
-        url = os.getenv("SUBSTRATE_ARCHIVE_NODE_URL")
-        thread_local.client = SubstrateInterface(url)
+        thread_local.client = PooledSubstrateInterface(get_node_pool())
     return thread_local.client
 
 
+def close_substrate_client():
+    """
+    Closes the calling thread's client and releases its endpoint, for threads that are about to
+    exit.
+    """
+    if hasattr(thread_local, "client"):
+        client = thread_local.client
+        del thread_local.client
+        try:
+            client.close()
+        except Exception:
+            pass
+
+
 def reconnect_substrate():
     print("Reconnecting Substrate...")
     if hasattr(thread_local, "client"):
+        client = thread_local.client
         del thread_local.client
+        client.pool.record_failure(client.url)
+        try:
+            client.close()
+        except Exception:
+            pass
     get_substrate_client()
 
 
+async_clients = {}
+
+
+async def get_async_substrate_client():
+    """
+    Returns the AsyncSubstrateInterface for the running event loop, connected to the best endpoint
+    of the archive node pool. A single client can keep many requests in flight.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in async_clients:
+        # Store the connecting task so concurrent callers share one client
+        async_clients[loop] = loop.create_task(_connect_async_substrate_client())
+    try:
+        return await async_clients[loop]
+    except Exception:
+        async_clients.pop(loop, None)
+        raise
+
+
+async def _connect_async_substrate_client():
+    pool = get_node_pool()
+    url = pool.acquire()
+    try:
+        client = AsyncSubstrateInterface(url)
+        await client.initialize()
+    except Exception:
+        pool.release(url)
+        raise
+    client.pool_url = url
+    return client
+
+
+async def close_async_substrate_client():
+    """
+    Closes the running event loop's client, if any, and releases its endpoint. The next call to
+    get_async_substrate_client connects again.
+    """
+    task = async_clients.pop(asyncio.get_running_loop(), None)
+    if task is None:
+        return
+    try:
+        client = await task
+    except Exception:
+        # Failed connections have released their endpoint already
+        return
+    try:
+        await client.close()
+    except Exception:
+        pass
+    finally:
+        get_node_pool().release(client.pool_url)
+
+
 @lru_cache
 def create_storage_key_cached(pallet, storage, args):
     return get_substrate_client().create_storage_key(pallet, storage, list(args))
+
+
+CONCAT_HASH_LENGTHS = {"Blake2_128Concat": 16, "Twox64Concat": 8, "Identity": 0}
+
+
+class StorageMapReader:
+    """
+    Lists and decodes the entries of a storage map whose keys start with a given prefix, the same
+    way `query_map` does, on the calling thread's substrate client.
+    """
+
+    def __init__(self, module, storage_function, block_hash):
+        self.substrate = get_substrate_client()
+        self.block_hash = block_hash
+        self.substrate.init_runtime(block_hash=block_hash)
+
+        pallet = self.substrate.metadata.get_metadata_pallet(module)
+        storage_item = pallet.get_storage_function(storage_function) if pallet else None
+        if storage_item is None:
+            raise StorageFunctionNotFound(f'Storage function "{module}.{storage_function}" not found')
+
+        self.value_type = storage_item.get_value_type_string()
+        param_types = storage_item.get_params_type_string()
+        if len(param_types) == 0:
+            raise ValueError(f"{module}.{storage_function} is not a map")
+        self.param_count = len(param_types)
+
+        key_type_string = []
+        for (hasher, param_type) in zip(storage_item.get_param_hashers(), param_types):
+            if hasher not in CONCAT_HASH_LENGTHS:
+                raise ValueError(f"Cannot decode keys hashed with {hasher}")
+            key_type_string.append(f"[u8; {CONCAT_HASH_LENGTHS[hasher]}]")
+            key_type_string.append(param_type)
+        self.key_type = f"({', '.join(key_type_string)})"
+
+        self.prefix = StorageKey.create_from_storage_function(
+            module, storage_item.value["name"], [],
+            runtime_config=self.substrate.runtime_config, metadata=self.substrate.metadata
+        ).to_hex()
+
+    def read_pages(self, key_prefix, page_size=1000):
+        """
+        Yields pages of (key, value) entries under `key_prefix`, decoded to scale objects.
+        """
+        start_key = None
+        while True:
+            keys = self.substrate.rpc_request(
+                "state_getKeysPaged", [key_prefix, page_size, start_key, self.block_hash]
+            )["result"]
+            entries = []
+            if keys:
+                result = self.substrate.rpc_request(
+                    "state_queryStorageAt", [keys, self.block_hash]
+                )["result"]
+                for change_set in result:
+                    for (key, value) in change_set["changes"]:
+                        if value is not None:
+                            entries.append(self.decode(key, value))
+            yield entries
+            if len(keys) < page_size:
+                return
+            start_key = keys[-1]
+
+    def decode(self, key, value):
+        key_obj = self.substrate.decode_scale(
+            type_string=self.key_type,
+            scale_bytes="0x" + key[len(self.prefix):],
+            return_scale_obj=True,
+            block_hash=self.block_hash
+        )
+        # Drop the hashes in front of every key
+        if self.param_count == 1:
+            item_key = key_obj.value_object[1]
+        else:
+            item_key = tuple(key_obj.value_object[i] for i in range(1, 2 * self.param_count, 2))
+        item_value = self.substrate.decode_scale(
+            type_string=self.value_type,
+            scale_bytes=value,
+            return_scale_obj=True,
+            block_hash=self.block_hash
+        )
+        return (item_key, item_value)
+
+
+def query_map_sharded(module, storage_function, block_hash, shards=None, workers=None,
+                      page_size=1000, on_shard_done=None):
+    """
+    Streams the (key, value) entries of a storage map like `substrate.query_map`, but reads it on
+    many threads at once. The keys are split into 256 shards by their first byte after the map
+    prefix, which is uniform for hashed keys, and each shard is paged through with
+    state_getKeysPaged and state_queryStorageAt.
+
+    Entries come in no particular order. At most a few pages per worker are held in memory, so
+    the consumer sets the pace. `shards` limits the read to some shards, and `on_shard_done(shard)`
+    is called once every entry of a shard has been yielded.
+    """
+    shards = list(range(256)) if shards is None else list(shards)
+    workers = min(workers or QUERY_MAP_WORKERS, len(shards))
+    if not shards:
+        return
+
+    pages = queue.Queue(maxsize=2 * workers)
+    pending_shards = queue.SimpleQueue()
+    for shard in shards:
+        pending_shards.put(shard)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def work():
+        try:
+            reader = StorageMapReader(module, storage_function, block_hash)
+            while not stop.is_set():
+                try:
+                    shard = pending_shards.get_nowait()
+                except queue.Empty:
+                    return
+                for entries in reader.read_pages(f"{reader.prefix}{shard:02x}", page_size):
+                    put((shard, entries, False))
+                put((shard, [], True))
+        except Exception as e:
+            put((None, e, True))
+        finally:
+            # Worker threads are not reused, their client would otherwise hold its endpoint forever
+            close_substrate_client()
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        done = 0
+        while done < len(shards):
+            (shard, entries, shard_done) = pages.get()
+            if isinstance(entries, Exception):
+                raise entries
+            yield from entries
+            if shard_done:
+                done += 1
+                if on_shard_done is not None:
+                    on_shard_done(shard)
+    finally:
+        stop.set()
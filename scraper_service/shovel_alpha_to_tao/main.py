@@ -1,32 +1,33 @@
+import asyncio
 from shared.clickhouse.batch_insert import buffer_insert
-from shared.shovel_base_class import ShovelBaseClass
-from shared.substrate import get_substrate_client
+from shared.async_shovel_base_class import AsyncShovelBaseClass
+from shared.substrate import get_async_substrate_client
 from shared.clickhouse.utils import (
     get_clickhouse_client,
     table_exists,
 )
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
-from shared.block_metadata import get_block_metadata
+from shared.block_metadata import get_async_block_metadata
 import logging
 
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(process)d %(message)s")
 
-class AlphaToTaoShovel(ShovelBaseClass):
+class AlphaToTaoShovel(AsyncShovelBaseClass):
     table_name = "shovel_alpha_to_tao"
 
     def __init__(self, name):
         super().__init__(name)
         self.starting_block = 4920351
 
-    def process_block(self, n):
-        do_process_block(self, n)
+    async def process_block(self, n):
+        await do_process_block(self, n)
 
 
-def do_process_block(self, n):
+async def do_process_block(self, n):
     try:
-        substrate = get_substrate_client()
+        substrate = await get_async_substrate_client()
 
         try:
             if not table_exists(self.table_name):
@@ -45,7 +46,7 @@ def do_process_block(self, n):
             raise DatabaseConnectionError(f"Failed to create/check table: {str(e)}")
 
         try:
-            block_timestamp, block_hash = get_block_metadata(n)
+            block_timestamp, block_hash = await get_async_block_metadata(n)
             if block_timestamp == 0 and n != 0:
                 raise ShovelProcessingError(f"Invalid block timestamp (0) for block {n}")
         except Exception as e:
@@ -53,28 +54,29 @@ def do_process_block(self, n):
 
         try:
             # Get list of active subnets
-            networks_added = substrate.query_map(
+            networks_added = await substrate.query_map(
                 'SubtensorModule',
                 'NetworksAdded',
                 block_hash=block_hash
             )
-            networks = [int(net[0].value) for net in networks_added]
+            # Single keyed map, so the key is the decoded netuid
+            networks = [netuid async for (netuid, _) in networks_added]
+
+            # Query every subnet concurrently
+            subnet_taos = asyncio.gather(*[
+                substrate.query('SubtensorModule', 'SubnetTAO', [netuid], block_hash=block_hash)
+                for netuid in networks
+            ])
+            subnet_alpha_ins = asyncio.gather(*[
+                substrate.query('SubtensorModule', 'SubnetAlphaIn', [netuid], block_hash=block_hash)
+                for netuid in networks
+            ])
+            subnet_taos, subnet_alpha_ins = await asyncio.gather(subnet_taos, subnet_alpha_ins)
 
             # Process each subnet
-            for netuid in networks:
-                subnet_tao = substrate.query(
-                    'SubtensorModule',
-                    'SubnetTAO',
-                    [netuid],
-                    block_hash=block_hash
-                ).value / 1e9
-
-                subnet_alpha_in = substrate.query(
-                    'SubtensorModule',
-                    'SubnetAlphaIn',
-                    [netuid],
-                    block_hash=block_hash
-                ).value / 1e9
+            for netuid, subnet_tao, subnet_alpha_in in zip(networks, subnet_taos, subnet_alpha_ins):
+                subnet_tao = subnet_tao.value / 1e9
+                subnet_alpha_in = subnet_alpha_in.value / 1e9
 
                 # Calculate exchange rate (TAO per Alpha)
                 alpha_to_tao = 1 if netuid == 0 else (subnet_tao / subnet_alpha_in if subnet_alpha_in > 0 else 0)
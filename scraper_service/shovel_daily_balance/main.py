@@ -3,25 +3,28 @@ import logging
 from shared.block_metadata import get_block_metadata
 from shared.clickhouse.batch_insert import buffer_insert
 from shared.clickhouse.utils import get_clickhouse_client, table_exists
-from shared.shovel_base_class import ShovelBaseClass
-from shared.substrate import get_substrate_client, reconnect_substrate
+from shared.snapshot_shovel_base_class import SnapshotShovelBaseClass
+from shared.substrate import query_map_sharded, reconnect_substrate
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(process)d %(message)s")
 
 BLOCKS_PER_DAY = 7200
+# System.Account is read in this many shards, each recorded here once written
+SHARDS = 256
+PROGRESS_TABLE = "shovel_balance_daily_map_progress"
 
-class BalanceDailyMapShovel(ShovelBaseClass):
+class BalanceDailyMapShovel(SnapshotShovelBaseClass):
     table_name = "shovel_balance_daily_map"
 
-    def process_block(self, n):
+    blocks_per_snapshot = BLOCKS_PER_DAY
+
+    def process_snapshot(self, n):
         do_process_block(n, self.table_name)
 
 
 def do_process_block(n, table_name):
-    if n % BLOCKS_PER_DAY != 0:
-        return
     try:
         # Create table if it doesn't exist
         try:
@@ -48,23 +51,39 @@ def do_process_block(n, table_name):
             raise ShovelProcessingError(f"Failed to get block metadata: {str(e)}")
 
         try:
-            results = fetch_all_free_balances_at_block(block_hash)
+            # Shards finished before a restart are not read again
+            shards_done = get_finished_shards(n)
+            shards = [shard for shard in range(SHARDS) if shard not in shards_done]
+            if shards_done:
+                logging.info(f"Resuming block {n} with {len(shards)} of {SHARDS} shards left")
         except Exception as e:
-            raise ShovelProcessingError(f"Failed to fetch balances from substrate: {str(e)}")
+            raise DatabaseConnectionError(f"Failed to read snapshot progress: {str(e)}")
 
-        if not results:
-            raise ShovelProcessingError(f"No balance data returned for block {n}")
+        progress = {"shards": len(shards_done), "accounts": 0}
 
-        logging.info(f"Processing block {n}. Found {len(results)} balance entries")
+        def shard_done(shard):
+            buffer_insert(PROGRESS_TABLE, [n, shard])
+            progress["shards"] += 1
+            if progress["shards"] % 16 == 0:
+                logging.info(
+                    f"Block {n}: {progress['shards']}/{SHARDS} shards, {progress['accounts']} accounts"
+                )
 
         try:
-            for address, balance in results.items():
+            # Rows are buffered as they arrive, so memory doesn't grow with the number of accounts
+            for (address, free, reserved, frozen) in iter_balances_at_block(block_hash, shards, shard_done):
                 buffer_insert(
                     table_name,
-                    [n, block_timestamp, f"'{address}'", balance["free"], balance["reserved"], balance["frozen"]]
+                    [n, block_timestamp, f"'{address}'", free, reserved, frozen]
                 )
+                progress["accounts"] += 1
         except Exception as e:
-            raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
+            raise ShovelProcessingError(f"Failed to fetch balances from substrate: {str(e)}")
+
+        if progress["accounts"] == 0 and not shards_done:
+            raise ShovelProcessingError(f"No balance data returned for block {n}")
+
+        logging.info(f"Processed block {n}. Found {progress['accounts']} balance entries")
 
     except (DatabaseConnectionError, ShovelProcessingError):
         # Re-raise these exceptions to be handled by the base class
@@ -74,38 +93,46 @@ def do_process_block(n, table_name):
         raise ShovelProcessingError(f"Unexpected error processing block {n}: {str(e)}")
 
 
-def fetch_all_free_balances_at_block(block_hash):
-    """Fetch all balances at a given block hash."""
-    try:
-        substrate = get_substrate_client()
-        raw_balances = substrate.query_map(
-            module='System',
-            storage_function='Account',
-            block_hash=block_hash,
-            page_size=1000
-        )
-
-        if not raw_balances:
-            raise ShovelProcessingError("No balance data returned from substrate")
-
-        balances = {}
-        for address in raw_balances:
-            try:
-                address_id = address[0].value
-                address_info = address[1]
-                balances[address_id] = {
-                    'free': address_info['data']['free'],
-                    'reserved': address_info['data']['reserved'],
-                    'frozen': address_info['data']['frozen'] if 'frozen' in address_info['data'] else int(address_info['data']['misc_frozen'].value) + int(address_info['data']['fee_frozen'].value),
-                }
-            except (KeyError, ValueError) as e:
-                logging.warning(f"Skipping malformed account data for {address}: {str(e)}")
-                continue
-
-        return balances
-
-    except Exception as e:
-        raise ShovelProcessingError(f"Error fetching balances: {str(e)}")
+def create_progress_table():
+    if not table_exists(PROGRESS_TABLE):
+        query = f"""
+        CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} (
+            block_number UInt64,
+            shard UInt16
+        ) ENGINE = ReplacingMergeTree()
+        ORDER BY (block_number, shard)
+        """
+        get_clickhouse_client().execute(query)
+
+
+def get_finished_shards(n):
+    """Returns the System.Account shards already written for the snapshot at block n."""
+    create_progress_table()
+    query = f"SELECT shard FROM {PROGRESS_TABLE} WHERE block_number = {n}"
+    return {r[0] for r in get_clickhouse_client().execute(query)}
+
+
+def iter_balances_at_block(block_hash, shards=None, on_shard_done=None):
+    """Yield (address, free, reserved, frozen) for every account at a given block hash."""
+    # Reads the map on QUERY_MAP_WORKERS threads at once
+    raw_balances = query_map_sharded(
+        module='System',
+        storage_function='Account',
+        block_hash=block_hash,
+        shards=shards,
+        page_size=1000,
+        on_shard_done=on_shard_done
+    )
+
+    for address in raw_balances:
+        try:
+            address_id = address[0].value
+            address_info = address[1]
+            frozen = address_info['data']['frozen'] if 'frozen' in address_info['data'] else int(address_info['data']['misc_frozen'].value) + int(address_info['data']['fee_frozen'].value)
+            yield (address_id, address_info['data']['free'], address_info['data']['reserved'], frozen)
+        except (KeyError, ValueError) as e:
+            logging.warning(f"Skipping malformed account data for {address}: {str(e)}")
+            continue
 
 
 def main():
@@ -4,7 +4,7 @@ import rust_bindings
 from shared.block_metadata import get_block_metadata
 from shared.clickhouse.batch_insert import buffer_insert
 from shared.clickhouse.utils import get_clickhouse_client, table_exists
-from shared.shovel_base_class import ShovelBaseClass
+from shared.snapshot_shovel_base_class import SnapshotShovelBaseClass
 from shared.substrate import reconnect_substrate
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
 
@@ -13,16 +13,16 @@ logging.basicConfig(level=logging.INFO,
 
 BLOCKS_PER_DAY = 7200
 
-class StakeDailyMapShovel(ShovelBaseClass):
+class StakeDailyMapShovel(SnapshotShovelBaseClass):
     table_name = "shovel_stake_daily_map"
 
-    def process_block(self, n):
+    blocks_per_snapshot = BLOCKS_PER_DAY
+
+    def process_snapshot(self, n):
         do_process_block(n, self.table_name)
 
 
 def do_process_block(n, table_name):
-    if n % BLOCKS_PER_DAY != 0:
-        return
     try:
         # Create table if it doesn't exist
         try:
@@ -1,72 +1,146 @@
-from shared.block_metadata import get_block_metadata
+from shared.block_bundle import get_block_bundle
 from shared.clickhouse.batch_insert import buffer_insert
 from shared.shovel_base_class import ShovelBaseClass
-from shared.substrate import get_substrate_client, reconnect_substrate
+from shared.substrate import reconnect_substrate
 from shared.clickhouse.utils import (
+    get_string_conversions,
     table_exists,
+    to_string_value,
 )
+from shared.decode_pool import decode_block
+from shared.event_decoding import EventFilter
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
 import logging
+import os
 
 from shovel_events.utils import (
+    CONSOLIDATED_TABLE,
+    STORAGE_LAYOUT,
+    VIEW_PREFIX,
     create_clickhouse_table,
-    generate_column_definitions,
+    create_consolidated_table,
+    create_event_view,
+    get_event_flattener,
     get_table_name,
+    quote_string,
 )
 
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(process)d %(message)s")
 
+# Optional EVENTS_INCLUDE/EVENTS_EXCLUDE filter, events it rejects are never decoded
+event_filter = EventFilter.from_env()
+
 
 class EventsShovel(ShovelBaseClass):
+    prefetch_workers = int(os.getenv("BLOCK_PREFETCH_WORKERS", "8"))
+
     def process_block(self, n):
         do_process_block(n)
 
+    def prefetch_block(self, n):
+        decode_block(get_block_bundle(n), flatten_events)
+
 
 def main():
     EventsShovel(name="events").start()
 
 
+def flatten_events(bundle):
+    """
+    Decodes the events of a block and flattens them into
+    [(event_index, module_id, event_id, column_names, column_types, row)].
+
+    Runs in a decode worker process when DECODE_WORKERS is set.
+    """
+    if bundle.raw_events is None and bundle.block_number != 0:
+        raise ShovelProcessingError(f"No events returned for block {bundle.block_number}")
+
+    rows = []
+    for e in bundle.events(event_filter):
+        event = e["event"]
+        # Let column generation errors propagate up - we want to fail on new event types
+        flattener = get_event_flattener(
+            event["module_id"], event["event_id"], event["attributes"], bundle.metadata_types
+        )
+        if STORAGE_LAYOUT == "consolidated":
+            row = [
+                quote_string(event["module_id"]),
+                quote_string(event["event_id"]),
+                flattener.extract_attributes(event["attributes"]),
+            ]
+        else:
+            row = flattener.extract(event["attributes"])
+
+        # Position in the block, needed to handle edge case of duplicate events in the same
+        # block. Kept from the full event list so filtered runs write the same index.
+        rows.append((
+            e["record_index"],
+            event["module_id"],
+            event["event_id"],
+            flattener.column_names,
+            flattener.column_types,
+            row,
+        ))
+    return rows
+
+
+# (module_id, event_id, column_names, column_types) -> (table or view name, positions of values to
+# write as strings), once it is known to exist
+table_names = {}
+
+
+def get_event_table(module_id, event_id, column_names, column_types, values):
+    key = (module_id, event_id, column_names, tuple(column_types))
+    if key in table_names:
+        return table_names[key]
+
+    string_conversions = ()
+    if STORAGE_LAYOUT == "consolidated":
+        table_name = get_table_name(module_id, event_id, column_names, prefix=VIEW_PREFIX)
+        if not table_exists(CONSOLIDATED_TABLE):
+            create_consolidated_table()
+        if not table_exists(table_name):
+            create_event_view(table_name, module_id, event_id, column_names, column_types)
+    else:
+        table_name = get_table_name(module_id, event_id, column_names)
+
+        # Dynamically create table if not exists
+        if not table_exists(table_name):
+            create_clickhouse_table(table_name, list(column_names), column_types, values)
+        else:
+            # Existing tables keep their column types
+            string_conversions = get_string_conversions(
+                table_name, ["UInt64", "DateTime", "UInt64"] + list(column_types)
+            )
+
+    table_names[key] = (table_name, string_conversions)
+    return table_names[key]
+
+
 def do_process_block(n):
     try:
         try:
-            substrate = get_substrate_client()
-            (block_timestamp, block_hash) = get_block_metadata(n)
+            bundle = get_block_bundle(n)
+            block_timestamp = bundle.timestamp
         except Exception as e:
             raise ShovelProcessingError(f"Failed to initialize block processing: {str(e)}")
 
         try:
-            events = substrate.query(
-                "System",
-                "Events",
-                block_hash=block_hash,
-            )
-            if not events and n != 0:
-                raise ShovelProcessingError(f"No events returned for block {n}")
+            events = decode_block(bundle, flatten_events)
+        except ShovelProcessingError:
+            raise
         except Exception as e:
-            raise ShovelProcessingError(f"Failed to fetch events from substrate: {str(e)}")
+            raise ShovelProcessingError(f"Failed to process events in block {n}: {str(e)}")
 
-        # Needed to handle edge case of duplicate events in the same block
-        event_id = 0
-        for e in events:
+        for (event_id, module_id, event_name, column_names, column_types, row) in events:
             try:
-                event = e.value["event"]
-                # Let column generation errors propagate up - we want to fail on new event types
-                (column_names, column_types, values) = generate_column_definitions(
-                    event["attributes"]
-                )
-
+                table_name = None
                 try:
-                    table_name = get_table_name(
-                        event["module_id"], event["event_id"], tuple(column_names)
+                    (table_name, string_conversions) = get_event_table(
+                        module_id, event_name, column_names, column_types, row
                     )
-
-                    # Dynamically create table if not exists
-                    if not table_exists(table_name):
-                        create_clickhouse_table(
-                            table_name, column_names, column_types, values)
-
                 except Exception as e:
                     raise DatabaseConnectionError(f"Failed to create/check table {table_name}: {str(e)}")
 
@@ -76,9 +150,13 @@ def do_process_block(n):
                         n,
                         block_timestamp,
                         event_id,
-                    ] + values
-                    buffer_insert(table_name, all_values)
-                    event_id += 1
+                    ] + row
+                    for i in string_conversions:
+                        all_values[i] = to_string_value(all_values[i])
+                    buffer_insert(
+                        CONSOLIDATED_TABLE if STORAGE_LAYOUT == "consolidated" else table_name,
+                        all_values
+                    )
                 except Exception as e:
                     raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
 
@@ -1,4 +1,6 @@
+import os
 import json
+import logging
 from functools import lru_cache
 from substrateinterface.base import is_valid_ss58_address
 from shared.clickhouse.utils import (
@@ -7,6 +9,12 @@ from shared.clickhouse.utils import (
     table_exists,
 )
 
+# "tables" writes every event shape to its own table. "consolidated" writes all events to a single
+# table with their attributes in a Map, and creates a view per event shape.
+STORAGE_LAYOUT = os.getenv("EVENTS_STORAGE_LAYOUT", "tables")
+CONSOLIDATED_TABLE = "shovel_events"
+VIEW_PREFIX = "shovel_events_view"
+
 
 def format_value(value):
     if value is None:
@@ -34,6 +42,9 @@ def format_value(value):
 
 
 def get_column_type(value):
+    """
+    Column type guessed from a value, for leaves the runtime metadata has no type for.
+    """
     if isinstance(value, str):
         return "String"
     elif isinstance(value, int):
@@ -49,41 +60,143 @@ def get_column_type(value):
         return "String"
 
 
-def generate_column_definitions(item, parent_key=None):
-    column_names = []
-    column_types = []
-    values = []
-
+def shape_signature(item):
+    """
+    Describes the structure of decoded event attributes: dict keys, tuple lengths and leaf types.
+    Two values with the same signature flatten to the same columns.
+    """
     if isinstance(item, dict):
-        for key, value in item.items():
-            column_name = f"{parent_key}__{key}" if parent_key else key
-            (_column_names, _column_types, _values) = generate_column_definitions(
-                value, column_name
-            )
-            column_names.extend(_column_names)
-            column_types.extend(_column_types)
-            values.extend(_values)
-
+        return (dict, tuple((key, shape_signature(value)) for key, value in item.items()))
     elif isinstance(item, tuple):
-        for i, item in enumerate(item):
-            item_key = f"tuple_{i}"
-            item_name = f"{parent_key}.{item_key}" if parent_key else item_key
-            (_column_names, _column_types, _values) = generate_column_definitions(
-                item, item_name
-            )
-            column_names.extend(_column_names)
-            column_types.extend(_column_types)
-            values.extend(_values)
+        return (tuple, tuple(shape_signature(value) for value in item))
+    else:
+        return type(item)
+
+
+def quote_string(value):
+    escaped_value = value.replace("'", "\\'")
+    return f"'{escaped_value}'"
 
+
+def raw_value(value):
+    """
+    Text of a value as stored in the consolidated attributes map, before quoting.
+    """
+    if isinstance(value, str):
+        return value
+    elif isinstance(value, list):
+        return json.dumps(value)
     else:
-        column_type = get_column_type(item)
-        if column_type is not None:
+        return str(value)
+
+
+class EventFlattener:
+    """
+    Flattens the attributes of one event shape into column values, without walking the attributes
+    or rebuilding column names.
+    """
+
+    def __init__(self, column_names, column_types, extract, extract_attributes):
+        self.column_names = column_names
+        self.column_types = column_types
+        self.extract = extract
+        # Formats the same leaves as a Map literal for the consolidated layout
+        self.extract_attributes = extract_attributes
+
+
+def format_array(value):
+    return f"[{','.join(quote_string(x) if isinstance(x, str) else str(x) for x in value)}]"
+
+
+def compile_flattener(attributes, derived_types=None):
+    """
+    Generates a specialised extraction function for the shape of `attributes`, which indexes
+    straight into every leaf and formats it according to its known type.
+
+    `derived_types` are the column types derived from the runtime metadata for every non-None
+    leaf, see `shared.metadata_types`. Leaves without a derived type fall back to guessing from
+    the value.
+    """
+    column_names = []
+    column_types = []
+    leaf_expressions = []
+    attribute_expressions = []
+    derived_types = iter(derived_types or ())
+
+    def walk(item, parent_key, accessor):
+        if isinstance(item, dict):
+            for key, value in item.items():
+                column_name = f"{parent_key}__{key}" if parent_key else key
+                walk(value, column_name, f"{accessor}[{key!r}]")
+        elif isinstance(item, tuple):
+            for i, value in enumerate(item):
+                item_key = f"tuple_{i}"
+                item_name = f"{parent_key}.{item_key}" if parent_key else item_key
+                walk(value, item_name, f"{accessor}[{i}]")
+        else:
+            column_type = get_column_type(item)
+            if column_type is None:
+                return
+            column_type = next(derived_types, None) or column_type
             column_name = parent_key if parent_key else "value"
             column_names.append(column_name)
             column_types.append(column_type)
-            values.append(format_value(item))
+            map_key = repr(f"{quote_string(column_name)}:")
+            # Same formatting as format_value, specialised by type
+            if column_type.startswith("Array("):
+                leaf_expressions.append(f"format_array({accessor})")
+                attribute_expressions.append(f"{map_key} + quote_string(format_array({accessor}))")
+            elif isinstance(item, (int, float)):
+                leaf_expressions.append(accessor)
+                attribute_expressions.append(f"{map_key} + quote_string(str({accessor}))")
+            elif isinstance(item, str):
+                leaf_expressions.append(f"quote_string({accessor})")
+                attribute_expressions.append(f"{map_key} + quote_string({accessor})")
+            else:
+                leaf_expressions.append(f"format_value({accessor})")
+                attribute_expressions.append(f"{map_key} + quote_string(raw_value({accessor}))")
+
+    walk(attributes, None, "attributes")
+
+    source = (
+        f"def extract(attributes):\n"
+        f"    return [{', '.join(leaf_expressions)}]\n"
+        f"def extract_attributes(attributes):\n"
+        f"    return '{{' + ','.join([{', '.join(attribute_expressions)}]) + '}}'\n"
+    )
+    namespace = {
+        "quote_string": quote_string,
+        "format_value": format_value,
+        "raw_value": raw_value,
+        "format_array": format_array,
+    }
+    exec(compile(source, "<event flattener>", "exec"), namespace)
+
+    return EventFlattener(
+        tuple(column_names), column_types, namespace["extract"], namespace["extract_attributes"]
+    )
+
+
+event_flatteners = {}
+
 
-    return (column_names, column_types, values)
+def get_event_flattener(module_id, event_id, attributes, metadata_types=None):
+    """
+    Returns the flattener for this event and attribute shape, compiling it on first sight with
+    column types from the event's definition in `metadata_types` where possible.
+    """
+    # Runtimes can derive different types for the same shape, MetadataTypes is cached per runtime
+    key = (module_id, event_id, shape_signature(attributes), metadata_types)
+    flattener = event_flatteners.get(key)
+    if flattener is None:
+        derived_types = None
+        if metadata_types is not None:
+            event_type = metadata_types.event_type(module_id, event_id)
+            if event_type is not None:
+                derived_types = metadata_types.leaf_types(attributes, event_type)
+        flattener = compile_flattener(attributes, derived_types)
+        event_flatteners[key] = flattener
+    return flattener
 
 
 def create_clickhouse_table(table_name, column_names, column_types, values):
@@ -95,7 +208,7 @@ def create_clickhouse_table(table_name, column_names, column_types, values):
 
     columns = list(
         map(
-            lambda x, y: f"{escape_column_name(x)} {y}",
+            lambda x, y: f"{escape_column_name(x)} {y} CODEC(ZSTD)",
             column_names,
             column_types,
         )
@@ -120,8 +233,50 @@ def create_clickhouse_table(table_name, column_names, column_types, values):
     get_clickhouse_client().execute(sql)
 
 
+def create_consolidated_table():
+    sql = f"""
+    CREATE TABLE IF NOT EXISTS {CONSOLIDATED_TABLE} (
+        block_number UInt64 CODEC(Delta, ZSTD),
+        timestamp DateTime CODEC(Delta, ZSTD),
+        event_index UInt64 CODEC(Delta(1), ZSTD),
+        module_id LowCardinality(String) CODEC(ZSTD),
+        event_id LowCardinality(String) CODEC(ZSTD),
+        attributes Map(LowCardinality(String), String) CODEC(ZSTD)
+    ) ENGINE = ReplacingMergeTree()
+    PARTITION BY toYYYYMM(timestamp)
+    ORDER BY (module_id, event_id, block_number, event_index)
+    """
+
+    get_clickhouse_client().execute(sql)
+
+
+def create_event_view(view_name, module_id, event_id, column_names, column_types):
+    """
+    Creates a view over the consolidated table with the same columns a per-event table would
+    have. Rows of other shapes of the same event are told apart by their attribute keys.
+    """
+    columns = []
+    for column_name, column_type in zip(column_names, column_types):
+        value = f"attributes[{quote_string(column_name)}]"
+        if column_type != "String":
+            value = f"CAST({value}, '{column_type}')"
+        columns.append(f"{value} AS {escape_column_name(column_name)}")
+    keys = ", ".join(quote_string(column_name) for column_name in column_names)
+
+    sql = f"""
+    CREATE VIEW IF NOT EXISTS {view_name} AS
+    SELECT {", ".join(["block_number", "timestamp", "event_index"] + columns)}
+    FROM {CONSOLIDATED_TABLE}
+    WHERE module_id = {quote_string(module_id)}
+        AND event_id = {quote_string(event_id)}
+        AND mapKeys(attributes) = [{keys}]
+    """
+
+    get_clickhouse_client().execute(sql)
+
+
 @lru_cache(maxsize=None)
-def get_table_name(module_id, event_id, columns):
+def get_table_name(module_id, event_id, columns, prefix="shovel_events"):
     """
     Returns a unique table name for the event_id and its columns.
 
@@ -141,7 +296,7 @@ def get_table_name(module_id, event_id, columns):
     MAX_VERSIONS = 50
 
     while version < MAX_VERSIONS:
-        table_name = f"shovel_events_{event_id}_v{version}"
+        table_name = f"{prefix}_{event_id}_v{version}"
 
         # If the stable doesn't exist, we will create it for this version of the event we are
         # processing
@@ -1,13 +1,18 @@
-from shared.block_metadata import get_block_metadata
+from shared.block_bundle import get_block_bundle
 from shared.clickhouse.batch_insert import buffer_insert
 from shared.clickhouse.utils import (
     get_clickhouse_client,
+    get_string_conversions,
     table_exists,
+    to_string_value,
 )
 from shared.shovel_base_class import ShovelBaseClass
-from shared.substrate import get_substrate_client, reconnect_substrate
+from shared.substrate import reconnect_substrate
+from shared.decode_pool import decode_block
+from shared.event_decoding import EventFilter
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
 import logging
+import os
 
 from shovel_extrinsics.utils import (
     create_clickhouse_table,
@@ -20,113 +25,146 @@ from shovel_extrinsics.utils import (
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(process)d %(message)s")
 
+# Only the events needed for the success map are decoded, the rest are skipped
+extrinsic_status_filter = EventFilter(include=["System.ExtrinsicSuccess", "System.ExtrinsicFailed"])
+
 
 class ExtrinsicsShovel(ShovelBaseClass):
+    prefetch_workers = int(os.getenv("BLOCK_PREFETCH_WORKERS", "8"))
+
     def process_block(self, n):
         do_process_block(n)
 
+    def prefetch_block(self, n):
+        decode_block(get_block_bundle(n), flatten_extrinsics)
+
 
 def main():
     ExtrinsicsShovel(name="extrinsics").start()
 
 
+def flatten_extrinsics(bundle):
+    """
+    Decodes the extrinsics of a block and flattens them into
+    [(call_module, call_function, column_names, column_types, values)].
+
+    Runs in a decode worker process when DECODE_WORKERS is set.
+    """
+    n = bundle.block_number
+    try:
+        extrinsics = bundle.extrinsics
+        if not extrinsics and n != 0:
+            raise ShovelProcessingError(f"No extrinsics returned for block {n}")
+
+        if bundle.raw_events is None and n != 0:
+            raise ShovelProcessingError(f"No events returned for block {n}")
+        events = bundle.events(extrinsic_status_filter)
+    except Exception as e:
+        raise ShovelProcessingError(f"Failed to fetch extrinsics or events from substrate: {str(e)}")
+
+    # Map extrinsic success/failure status
+    extrinsics_success_map = {}
+    for event in events:
+        extrinsics_success_map[int(event["extrinsic_idx"])] = event["event"]["event_id"] == "ExtrinsicSuccess"
+
+    rows = []
+    # Needed to handle edge case of duplicate events in the same block
+    extrinsic_id = 0
+    for e in extrinsics:
+        try:
+            extrinsic = e
+            address = extrinsic.get("address", None)
+            nonce = extrinsic.get("nonce", None)
+            tip = extrinsic.get("tip", None)
+            call_function = extrinsic["call"]["call_function"]
+            call_module = extrinsic["call"]["call_module"]
+
+            base_column_names = ["block_number", "timestamp", "extrinsic_index",
+                               "call_function", "call_module", "success", "address", "nonce", "tip"]
+            base_column_types = ["UInt64", "DateTime", "UInt64", "LowCardinality(String)",
+                               "LowCardinality(String)", "Bool", "Nullable(String)", "Nullable(UInt64)", "Nullable(UInt64)"]
+
+            base_column_values = [format_value(value) for value in [
+                n, bundle.timestamp, extrinsic_id, call_function, call_module, extrinsics_success_map[extrinsic_id], address, nonce, tip]]
+
+            # Column types come from the call's definition in the runtime metadata where possible
+            arg_types = None
+            if bundle.metadata_types is not None:
+                arg_types = bundle.metadata_types.call_arg_types(call_module, call_function)
+
+            # Let column generation errors propagate up - we want to fail on new extrinsic types
+            arg_column_names = []
+            arg_column_types = []
+            arg_values = []
+            for arg in extrinsic["call"]["call_args"]:
+                derived_types = None
+                if arg_types is not None and arg["name"] in arg_types:
+                    derived_types = iter(bundle.metadata_types.leaf_types(arg["value"], arg_types[arg["name"]]))
+                (_arg_column_names, _arg_column_types, _arg_values) = generate_column_definitions(
+                    arg["value"], arg["name"], arg["type"], derived_types
+                )
+                arg_column_names.extend(_arg_column_names)
+                arg_column_types.extend(_arg_column_types)
+                arg_values.extend(_arg_values)
+
+            column_names = base_column_names + arg_column_names
+            column_types = base_column_types + arg_column_types
+            values = base_column_values + arg_values
+
+            rows.append((call_module, call_function, tuple(column_names), column_types, values))
+            extrinsic_id += 1
+
+        except Exception as e:
+            # Convert any other errors to ShovelProcessingError to fail the shovel
+            raise ShovelProcessingError(f"Failed to process extrinsic in block {n}: {str(e)}")
+
+    # Verify we processed all extrinsics
+    if len(extrinsics_success_map) != extrinsic_id:
+        raise ShovelProcessingError(
+            f"Expected {len(extrinsics_success_map)} extrinsics, but only found {extrinsic_id}")
+
+    return rows
+
+
 def do_process_block(n):
     try:
         try:
-            substrate = get_substrate_client()
-            (block_timestamp, block_hash) = get_block_metadata(n)
+            bundle = get_block_bundle(n)
         except Exception as e:
             raise ShovelProcessingError(f"Failed to initialize block processing: {str(e)}")
 
         try:
-            extrinsics = substrate.get_extrinsics(block_number=n)
-            if not extrinsics and n != 0:
-                raise ShovelProcessingError(f"No extrinsics returned for block {n}")
-
-            events = substrate.query(
-                "System",
-                "Events",
-                block_hash=block_hash,
-            )
-            if not events and n != 0:
-                raise ShovelProcessingError(f"No events returned for block {n}")
+            rows = decode_block(bundle, flatten_extrinsics)
+        except ShovelProcessingError:
+            raise
         except Exception as e:
-            raise ShovelProcessingError(f"Failed to fetch extrinsics or events from substrate: {str(e)}")
-
-        # Map extrinsic success/failure status
-        extrinsics_success_map = {}
-        for e in events:
-            event = e.value
-            # Skip irrelevant events
-            if event["event"]["module_id"] != "System" or (event["event"]["event_id"] != "ExtrinsicSuccess" and event["event"]["event_id"] != "ExtrinsicFailed"):
-                continue
-
-            extrinsics_success_map[int(event["extrinsic_idx"])] = event["event"]["event_id"] == "ExtrinsicSuccess"
+            raise ShovelProcessingError(f"Failed to process extrinsics in block {n}: {str(e)}")
 
-        # Needed to handle edge case of duplicate events in the same block
-        extrinsic_id = 0
-        for e in extrinsics:
+        for (call_module, call_function, column_names, column_types, values) in rows:
+            table_name = None
             try:
-                extrinsic = e.value
-                address = extrinsic.get("address", None)
-                nonce = extrinsic.get("nonce", None)
-                tip = extrinsic.get("tip", None)
-                call_function = extrinsic["call"]["call_function"]
-                call_module = extrinsic["call"]["call_module"]
-
-                base_column_names = ["block_number", "timestamp", "extrinsic_index",
-                                   "call_function", "call_module", "success", "address", "nonce", "tip"]
-                base_column_types = ["UInt64", "DateTime", "UInt64", "String",
-                                   "String", "Bool", "Nullable(String)", "Nullable(UInt64)", "Nullable(UInt64)"]
-
-                base_column_values = [format_value(value) for value in [
-                    n, block_timestamp, extrinsic_id, call_function, call_module, extrinsics_success_map[extrinsic_id], address, nonce, tip]]
-
-                # Let column generation errors propagate up - we want to fail on new extrinsic types
-                arg_column_names = []
-                arg_column_types = []
-                arg_values = []
-                for arg in extrinsic["call"]["call_args"]:
-                    (_arg_column_names, _arg_column_types, _arg_values) = generate_column_definitions(
-                        arg["value"], arg["name"], arg["type"]
+                table_name = get_table_name(
+                    call_module, call_function, column_names
+                )
+
+                # Dynamically create table if not exists
+                string_conversions = ()
+                if not table_exists(table_name):
+                    create_clickhouse_table(
+                        table_name, list(column_names), column_types
                     )
-                    arg_column_names.extend(_arg_column_names)
-                    arg_column_types.extend(_arg_column_types)
-                    arg_values.extend(_arg_values)
-
-                column_names = base_column_names + arg_column_names
-                column_types = base_column_types + arg_column_types
-                values = base_column_values + arg_values
-
-                try:
-                    table_name = get_table_name(
-                        call_module, call_function, tuple(column_names)
-                    )
-
-                    # Dynamically create table if not exists
-                    if not table_exists(table_name):
-                        create_clickhouse_table(
-                            table_name, column_names, column_types
-                        )
-                except Exception as e:
-                    raise DatabaseConnectionError(f"Failed to create/check table {table_name}: {str(e)}")
-
-                try:
-                    buffer_insert(table_name, values)
-                    extrinsic_id += 1
-                except Exception as e:
-                    raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
-
-            except DatabaseConnectionError:
-                raise
+                else:
+                    # Existing tables keep their column types
+                    string_conversions = get_string_conversions(table_name, column_types)
             except Exception as e:
-                # Convert any other errors to ShovelProcessingError to fail the shovel
-                raise ShovelProcessingError(f"Failed to process extrinsic in block {n}: {str(e)}")
+                raise DatabaseConnectionError(f"Failed to create/check table {table_name}: {str(e)}")
 
-        # Verify we processed all extrinsics
-        if len(extrinsics_success_map) != extrinsic_id:
-            raise ShovelProcessingError(
-                f"Expected {len(extrinsics_success_map)} extrinsics, but only found {extrinsic_id}")
+            try:
+                for i in string_conversions:
+                    values[i] = to_string_value(values[i])
+                buffer_insert(table_name, values)
+            except Exception as e:
+                raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
 
     except (DatabaseConnectionError, ShovelProcessingError):
         # Re-raise these exceptions to be handled by the base class
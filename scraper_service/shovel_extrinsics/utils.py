@@ -1,4 +1,5 @@
 import json
+import logging
 from functools import lru_cache
 from shared.clickhouse.utils import (
     escape_column_name,
@@ -60,11 +61,9 @@ def get_column_type(value, value_type=None, key=None):
         elif key in type_map:
             return type_map[key]
         else:
-            print(
-                f"Empty list and don't know what column type to use for key {
-                    key}!"
-            )
-            exit(1)
+            # Stored as a JSON string, a new call shape should never stall ingestion
+            logging.warning(f"Empty list and don't know what column type to use for key {key}, using String")
+            return "String"
     elif value is None:
         return None
     else:
@@ -91,7 +90,12 @@ type_map = {
 }
 
 
-def generate_column_definitions(item, parent_key, item_type=None):
+def generate_column_definitions(item, parent_key, item_type=None, derived_types=None):
+    """
+    Flattens a call arg into columns. `derived_types` iterates over the column types derived from
+    the runtime metadata for every non-None leaf, see `shared.metadata_types`. Leaves without a
+    derived type fall back to guessing from the value.
+    """
     column_names = []
     column_types = []
     values = []
@@ -100,7 +104,7 @@ def generate_column_definitions(item, parent_key, item_type=None):
         for key, value in item.items():
             column_name = f"{parent_key}__{key}"
             (_column_names, _column_types, _values) = generate_column_definitions(
-                value, column_name
+                value, column_name, derived_types=derived_types
             )
             column_names.extend(_column_names)
             column_types.extend(_column_types)
@@ -110,13 +114,17 @@ def generate_column_definitions(item, parent_key, item_type=None):
             item_key = f"tuple_{i}"
             item_name = f"{parent_key}.{item_key}"
             (_column_names, _column_types, _values) = generate_column_definitions(
-                item, item_name
+                item, item_name, derived_types=derived_types
             )
             column_names.extend(_column_names)
             column_types.extend(_column_types)
             values.extend(_values)
     else:
-        column_type = get_column_type(item, item_type, parent_key)
+        column_type = None
+        if item is not None and derived_types is not None:
+            column_type = next(derived_types, None)
+        if column_type is None:
+            column_type = get_column_type(item, item_type, parent_key)
         if column_type is not None:
             column_name = parent_key
             column_names.append(f"arg_{column_name}")
@@ -130,7 +138,7 @@ def create_clickhouse_table(table_name, column_names, column_types):
     columns = list(
         map(
             lambda x, y: f"{escape_column_name(x)} {
-                y}",
+                y}{" CODEC(ZSTD)" if x.startswith("arg_") else ""}",
             column_names,
             column_types,
         )
@@ -1,3 +1,4 @@
+from shared.as_of import OWNER_CHANGES_TABLE, create_owner_changes_table, get_owners_as_of
 from shared.block_metadata import get_block_metadata
 from shared.clickhouse.batch_insert import buffer_insert
 from shared.shovel_base_class import ShovelBaseClass
@@ -7,50 +8,49 @@ from shared.clickhouse.utils import (
     table_exists,
 )
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
+from shared.storage_changes import OWNER_PREFIX, StoragePrefixTracker
+from scalecodec.utils.ss58 import ss58_encode
 import logging
+import os
 
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(process)d %(message)s")
 
-last_proof = None
+# "snapshots" writes every owner every block, "changes" only the owners that changed
+STORAGE_LAYOUT = os.getenv("HOTKEY_OWNER_MAP_LAYOUT", "snapshots")
 
-last_owners = []
+owners_tracker = StoragePrefixTracker(OWNER_PREFIX)
 
-OWNERS_PREFIX = "0x658faa385070e074c85bf6b568cf0555eca6b7a1fdc9f689184ecb4f359c0518"
+# hotkey -> coldkey
+owners = {}
 
 
-def check_root_read_proof(block_hash):
-    """Check if the owner map has changed using storage proof."""
-    global last_proof
-
-    try:
-        substrate = get_substrate_client()
-        r = substrate.rpc_request(
-            "state_getReadProof",
-            params=[[OWNERS_PREFIX], block_hash]
-        )
-        this_stakes_proof = set(r["result"]["proof"])
-        map_changed = last_proof is None or last_proof.isdisjoint(
-            this_stakes_proof
-        )
-        last_proof = this_stakes_proof
-
-        return map_changed
-    except Exception as e:
-        raise ShovelProcessingError(f"Failed to check root read proof: {str(e)}")
+def apply_owner_changes(changes, ss58_format):
+    """
+    Applies changed Owner entries, keyed by Blake2_128Concat(hotkey) with the coldkey as value.
+    Returns {hotkey: coldkey} for the changed owners, with None for removed hotkeys.
+    """
+    changed_owners = {}
+    for (key, value) in changes.items():
+        hotkey = ss58_encode(key[-64:], ss58_format)
+        if value is None:
+            owners.pop(hotkey, None)
+            changed_owners[hotkey] = None
+        else:
+            owners[hotkey] = ss58_encode(value[2:], ss58_format)
+            changed_owners[hotkey] = owners[hotkey]
+    return changed_owners
 
 
 class HotkeyOwnerMapShovel(ShovelBaseClass):
-    table_name = "shovel_hotkey_owner_map"
+    table_name = OWNER_CHANGES_TABLE if STORAGE_LAYOUT == "changes" else "shovel_hotkey_owner_map"
 
     def process_block(self, n):
         do_process_block(self, n)
 
 
 def do_process_block(self, n):
-    global last_owners
-
     try:
         try:
             substrate = get_substrate_client()
@@ -59,7 +59,9 @@ def do_process_block(self, n):
 
         # Create table if it doesn't exist
         try:
-            if not table_exists(self.table_name):
+            if STORAGE_LAYOUT == "changes":
+                create_owner_changes_table()
+            elif not table_exists(self.table_name):
                 query = f"""
                 CREATE TABLE IF NOT EXISTS {self.table_name} (
                     block_number UInt64 CODEC(Delta, ZSTD),
@@ -79,34 +81,50 @@ def do_process_block(self, n):
         except Exception as e:
             raise ShovelProcessingError(f"Failed to get block metadata: {str(e)}")
 
+        # The first block after a start reads the whole map, which is diffed against the owners
+        # written before the restart so that hotkeys removed in between are written as removed
+        persisted_owners = None
+        if STORAGE_LAYOUT == "changes" and owners_tracker.state_root is None:
+            try:
+                persisted_owners = get_owners_as_of(n - 1) if n > 0 else {}
+            except Exception as e:
+                raise DatabaseConnectionError(f"Failed to read persisted owners: {str(e)}")
+
         try:
-            map_changed = check_root_read_proof(block_hash)
-        except ShovelProcessingError:
-            raise
+            # Only the shards of the map that changed since the last block are read
+            changes = owners_tracker.update(block_hash)
         except Exception as e:
-            raise ShovelProcessingError(f"Failed to check if owner map changed: {str(e)}")
+            raise ShovelProcessingError(f"Failed to read owner map changes: {str(e)}")
 
         try:
-            # Store owners for every block for fast queries
-            owners = last_owners if map_changed is False else substrate.query_map(
-                "SubtensorModule",
-                "Owner",
-                block_hash=block_hash,
-                page_size=1000
-            )
+            changed_owners = apply_owner_changes(changes, substrate.ss58_format)
 
             if not owners and n != 0:
                 raise ShovelProcessingError(f"No owner data returned for block {n}")
 
-            if map_changed:
-                last_owners = owners
+            if persisted_owners is not None:
+                changed_owners = {
+                    hotkey: coldkey for (hotkey, coldkey) in owners.items()
+                    if persisted_owners.get(hotkey) != coldkey
+                }
+                for hotkey in persisted_owners:
+                    if hotkey not in owners:
+                        changed_owners[hotkey] = None
 
             try:
-                for (hotkey, coldkey) in owners:
-                    buffer_insert(
-                        self.table_name,
-                        [n, block_timestamp, f"'{hotkey}'", f"'{coldkey}'"]
-                    )
+                if STORAGE_LAYOUT == "changes":
+                    for (hotkey, coldkey) in changed_owners.items():
+                        buffer_insert(
+                            self.table_name,
+                            [n, block_timestamp, f"'{hotkey}'", f"'{coldkey or ''}'"]
+                        )
+                else:
+                    # Store owners for every block for fast queries
+                    for (hotkey, coldkey) in owners.items():
+                        buffer_insert(
+                            self.table_name,
+                            [n, block_timestamp, f"'{hotkey}'", f"'{coldkey}'"]
+                        )
             except Exception as e:
                 raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
 
@@ -0,0 +1,169 @@
+import os
+import sys
+import logging
+import importlib
+from time import sleep
+
+from shared.async_shovel_base_class import AsyncShovelBaseClass
+from shared.block_bundle import BLOCK_BUNDLE_CACHE_SIZE
+from shared.clickhouse.batch_insert import InsertBuffer, use_buffer
+from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
+from shared.rpc_cache import mark_finalized
+from shared.runtime_metadata import warm_runtime_metadata
+from shared.snapshot_shovel_base_class import SnapshotShovelBaseClass
+from shared.substrate import close_async_substrate_client, get_substrate_client, reconnect_substrate
+
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s %(process)d %(message)s")
+
+# Shovels that can share a process: (module, class, checkpoint name). Shovels with their own
+# rust_bindings build or non-package imports still run in their own container.
+SHOVELS = {
+    "block_timestamp": ("shovel_block_timestamp.main", "BlockTimestampShovel", "block_timestamps"),
+    "events": ("shovel_events.main", "EventsShovel", "events"),
+    "extrinsics": ("shovel_extrinsics.main", "ExtrinsicsShovel", "extrinsics"),
+    "hotkey_owner_map": ("shovel_hotkey_owner_map.main", "HotkeyOwnerMapShovel", "hotkey_owner_map"),
+    "daily_balance": ("shovel_daily_balance.main", "BalanceDailyMapShovel", "balance_daily_map"),
+    "alpha_to_tao": ("shovel_alpha_to_tao.main", "AlphaToTaoShovel", "alpha_to_tao"),
+}
+
+
+def load_shovels(names):
+    shovels = []
+    for name in names:
+        if name not in SHOVELS:
+            raise ValueError(f"Unknown shovel {name}, expected one of {', '.join(SHOVELS)}")
+        (module_name, class_name, checkpoint_name) = SHOVELS[name]
+        shovel_class = getattr(importlib.import_module(module_name), class_name)
+        shovels.append(shovel_class(name=checkpoint_name))
+    return shovels
+
+
+class ShovelRunner:
+    """
+    Runs several shovels in one process. They share a block cursor, and through the process wide
+    caches a block fetch, a substrate connection and the runtime metadata. Each shovel keeps its
+    own buffer and checkpoint, so it resumes from its own progress after a restart.
+    """
+
+    MAX_RETRIES = 3
+    RETRY_DELAY = 5
+
+    def __init__(self, shovels):
+        self.shovels = shovels
+        self.next_blocks = {}
+
+    def start(self):
+        retry_count = 0
+        try:
+            print("Initialising Substrate client")
+            substrate = get_substrate_client()
+
+            print("Fetching the finalized block")
+            finalized_block_hash = substrate.get_chain_finalised_head()
+            finalized_block_number = substrate.get_block_number(finalized_block_hash)
+            mark_finalized(finalized_block_number)
+
+            print("Starting Clickhouse buffers")
+            for shovel in self.shovels:
+                shovel.insert_buffer = InsertBuffer()
+                shovel.start_buffer_flush()
+
+            self.load_checkpoints()
+
+            while True:
+                try:
+                    first_block_number = min(self.next_blocks.values())
+                    if first_block_number <= finalized_block_number:
+                        try:
+                            warm_runtime_metadata(substrate, first_block_number, finalized_block_number)
+                        except Exception as e:
+                            logging.warning(f"Failed to warm runtime metadata cache: {str(e)}")
+
+                        block_numbers = range(first_block_number, finalized_block_number + 1)
+                        logging.info(f"Catching up {len(block_numbers)} blocks")
+                        self.process_blocks(block_numbers)
+                    else:
+                        logging.info("Already up to latest finalized block, checking again in 12s...")
+
+                    # Reset retry count on successful iteration
+                    retry_count = 0
+
+                    sleep(12)
+                    finalized_block_hash = substrate.get_chain_finalised_head()
+                    finalized_block_number = substrate.get_block_number(finalized_block_hash)
+                    mark_finalized(finalized_block_number)
+
+                except DatabaseConnectionError as e:
+                    retry_count += 1
+                    if retry_count > self.MAX_RETRIES:
+                        logging.error(f"Max retries ({self.MAX_RETRIES}) exceeded for database connection. Exiting.")
+                        raise ShovelProcessingError("Max database connection retries exceeded")
+
+                    logging.warning(f"Database connection error (attempt {retry_count}/{self.MAX_RETRIES}): {str(e)}")
+                    logging.info(f"Retrying in {self.RETRY_DELAY} seconds...")
+                    sleep(self.RETRY_DELAY)
+                    self.reconnect()
+                    substrate = get_substrate_client()
+                    self.load_checkpoints()
+
+        except ShovelProcessingError as e:
+            logging.error(f"Fatal shovel error: {str(e)}")
+            sys.exit(1)
+        except Exception as e:
+            logging.error(f"Unexpected error: {str(e)}")
+            sys.exit(1)
+
+    def load_checkpoints(self):
+        for shovel in self.shovels:
+            self.next_blocks[shovel.name] = shovel.restore_state(shovel.get_checkpoint()) + 1
+            logging.info(f"Last scraped block for {shovel.name} is {self.next_blocks[shovel.name] - 1}")
+
+    def process_blocks(self, block_numbers):
+        """
+        Walks the blocks in windows small enough for their bundles to stay cached. Each shovel
+        processes its due blocks of a window through its own process_blocks, so prefetching and
+        async batches still apply. Snapshot shovels get the whole range at once to backfill it.
+        """
+        last_block_number = block_numbers[-1]
+        window_start = block_numbers[0]
+        while window_start <= last_block_number:
+            window_end = min(window_start + BLOCK_BUNDLE_CACHE_SIZE // 2 - 1, last_block_number)
+            for shovel in self.shovels:
+                end = last_block_number if isinstance(shovel, SnapshotShovelBaseClass) else window_end
+                due = list(range(self.next_blocks[shovel.name], end + 1, shovel.skip_interval))
+                if not due:
+                    continue
+                self.process_shovel_blocks(shovel, due)
+                self.next_blocks[shovel.name] = due[-1] + shovel.skip_interval
+            window_start = window_end + 1
+
+    def process_shovel_blocks(self, shovel, block_numbers):
+        with use_buffer(shovel.insert_buffer):
+            try:
+                shovel.process_blocks(block_numbers)
+            except (DatabaseConnectionError, ShovelProcessingError):
+                logging.error(f"{shovel.name} failed to process blocks {block_numbers[0]} to {block_numbers[-1]}")
+                raise
+            except Exception as e:
+                logging.error(f"Fatal error while {shovel.name} was processing blocks: {str(e)}")
+                raise ShovelProcessingError(f"Shovel {shovel.name} failed to process blocks: {str(e)}")
+
+    def reconnect(self):
+        reconnect_substrate()
+        for shovel in self.shovels:
+            if isinstance(shovel, AsyncShovelBaseClass):
+                shovel.loop.run_until_complete(close_async_substrate_client())
+
+
+def main():
+    names = [name.strip() for name in os.getenv("SHOVELS", "").split(",") if name.strip()]
+    if not names:
+        logging.error(f"Set SHOVELS to a comma separated list of: {', '.join(SHOVELS)}")
+        sys.exit(1)
+    ShovelRunner(load_shovels(names)).start()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 from collections import defaultdict
+import os
 import logging
 from shared.clickhouse.utils import (
     get_clickhouse_client,
@@ -8,9 +9,10 @@ from shared.substrate import get_substrate_client
 from shared.shovel_base_class import ShovelBaseClass
 from shared.clickhouse.batch_insert import buffer_insert
 from shared.block_metadata import get_block_metadata
+from shared.block_bundle import get_block_bundle
+from shared.event_decoding import EventFilter
+from shared.as_of import STAKES_CHANGES_TABLE, create_stakes_as_of_view
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
-from datetime import datetime
-import time
 import rust_bindings
 from tqdm import tqdm
 from functools import lru_cache
@@ -19,46 +21,86 @@ from functools import lru_cache
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(process)d %(message)s")
 
-last_stakes_proof = None
+# "snapshots" writes the whole stake map every block, "changes" only the entries that changed
+# plus a full snapshot every STAKE_MAP_SNAPSHOT_INTERVAL blocks
+STORAGE_LAYOUT = os.getenv("STAKE_MAP_LAYOUT", "snapshots")
+SNAPSHOT_INTERVAL = int(os.getenv("STAKE_MAP_SNAPSHOT_INTERVAL", "7200"))
+STATE_SNAPSHOT_INTERVAL = int(os.getenv("STATE_SNAPSHOT_INTERVAL", "7200"))
+
 prev_pending_emissions = {}
 stake_map = dict()
+last_snapshot_block = None
 
-STAKES_PREFIX = "0x658faa385070e074c85bf6b568cf055522fbe0bd0cb77b6b6f365f641b0de381"
-
+stake_events_filter = EventFilter(
+    include=["SubtensorModule.StakeAdded", "SubtensorModule.StakeRemoved"]
+)
 
-def check_root_read_proof(block_hash):
-    """Check if the stake map has changed using storage proof."""
-    global last_stakes_proof
 
-    try:
-        substrate = get_substrate_client()
-        r = substrate.rpc_request(
-            "state_getReadProof",
-            params=[[STAKES_PREFIX], block_hash]
-        )
-        this_stakes_proof = set(r["result"]["proof"])
-        stake_map_changed = last_stakes_proof is None or last_stakes_proof.isdisjoint(
-            this_stakes_proof
-        )
-        last_stakes_proof = this_stakes_proof
-
-        return stake_map_changed
-    except Exception as e:
-        raise ShovelProcessingError(f"Failed to check root read proof: {str(e)}")
+def get_event_hotkey(event, metadata_types):
+    """
+    Returns the hotkey of a StakeAdded or StakeRemoved event, from the position of its `hotkey`
+    field in the runtime metadata.
+    """
+    fields = metadata_types.events.get((event["module_id"], event["event_id"])) or []
+    for (index, field) in enumerate(fields):
+        if field["name"] == "hotkey":
+            return event["attributes"][index]
+    raise ShovelProcessingError(
+        f"{event['module_id']}.{event['event_id']} has no hotkey field in the runtime metadata"
+    )
 
 
 class StakeDoubleMapShovel(ShovelBaseClass):
-    table_name = "shovel_stake_double_map"
+    table_name = STAKES_CHANGES_TABLE if STORAGE_LAYOUT == "changes" else "shovel_stake_double_map"
+
+    snapshot_interval = STATE_SNAPSHOT_INTERVAL
 
     def process_block(self, n):
         do_process_block(n, self.table_name)
 
+    def get_state(self):
+        return {
+            "stake_map": stake_map,
+            "prev_pending_emissions": prev_pending_emissions,
+            "last_snapshot_block": last_snapshot_block,
+        }
+
+    def set_state(self, state):
+        global last_snapshot_block
+        stake_map.clear()
+        stake_map.update(state["stake_map"])
+        prev_pending_emissions.clear()
+        prev_pending_emissions.update(state["prev_pending_emissions"])
+        last_snapshot_block = state["last_snapshot_block"]
+
+
+def create_changes_table(table_name):
+    if not table_exists(table_name):
+        query = f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            block_number UInt64 CODEC(Delta, ZSTD),
+            timestamp DateTime CODEC(Delta, ZSTD),
+            hotkey String CODEC(ZSTD),
+            coldkey String CODEC(ZSTD),
+            stake UInt64 CODEC(Delta, ZSTD),
+            is_snapshot UInt8 CODEC(ZSTD)
+        ) ENGINE = ReplacingMergeTree()
+        PARTITION BY toYYYYMM(timestamp)
+        ORDER BY (block_number, hotkey, coldkey)
+        """
+        get_clickhouse_client().execute(query)
+    create_stakes_as_of_view()
+
 
 def do_process_block(n, table_name):
+    global last_snapshot_block
+
     try:
         # Create table if it doesn't exist
         try:
-            if not table_exists(table_name):
+            if STORAGE_LAYOUT == "changes":
+                create_changes_table(table_name)
+            elif not table_exists(table_name):
                 query = f"""
                 CREATE TABLE IF NOT EXISTS {table_name} (
                     block_number UInt64 CODEC(Delta, ZSTD),
@@ -144,54 +186,46 @@ def do_process_block(n, table_name):
             raise ShovelProcessingError(f"Failed to process subnet data: {str(e)}")
 
         try:
-            # Check if we're up to date with dependencies
-            events_synced_block_query = "SELECT block_number FROM shovel_checkpoints FINAL WHERE shovel_name = 'events';"
-            events_synced_block = get_clickhouse_client().execute(
-                events_synced_block_query)[0][0]
-            hotkey_owner_map_synced_block_query = "SELECT block_number FROM shovel_checkpoints FINAL WHERE shovel_name = 'hotkey_owner_map';"
-            hotkey_owner_map_synced_block = get_clickhouse_client().execute(
-                hotkey_owner_map_synced_block_query)[0][0]
-
-            while (events_synced_block < n or hotkey_owner_map_synced_block < n):
-                logging.info("Waiting for events and hotkey_owner_map tables to sync...")
-                time.sleep(60)
-                events_synced_block = get_clickhouse_client().execute(
-                    events_synced_block_query)[0][0]
-                hotkey_owner_map_synced_block = get_clickhouse_client().execute(
-                    hotkey_owner_map_synced_block_query)[0][0]
-
-            # Get hotkeys with stake events this block
-            dt_object = datetime.fromtimestamp(block_timestamp)
-            formatted_date = dt_object.strftime("%Y-%m-%d %H:%M:%S")
-            distinct_hotkeys_query = f"""
-                SELECT DISTINCT(hotkey) from agg_stake_events WHERE timestamp = '{formatted_date}'
-            """
-            distinct_hotkeys = get_clickhouse_client().execute(distinct_hotkeys_query)
-
-            for r in distinct_hotkeys:
-                hotkeys_needing_update.add(r[0])
-
+            # Hotkeys with stake added or removed in this block
+            bundle = get_block_bundle(n)
+            for e in bundle.events(stake_events_filter):
+                hotkeys_needing_update.add(get_event_hotkey(e["event"], bundle.metadata_types))
         except Exception as e:
-            raise DatabaseConnectionError(f"Failed to check dependency sync status: {str(e)}")
+            raise ShovelProcessingError(f"Failed to get stake events: {str(e)}")
 
         try:
-            # Get agg stake events for this block
+            # Get the stakes of every touched hotkey
             r = rust_bindings.query_hotkeys_stakes(
                 block_hash, list(hotkeys_needing_update)
             )
             if r is None:
                 raise ShovelProcessingError(f"Failed to get stakes for hotkeys in block {n}")
 
+            changed = {}
             for (hotkey, coldkey_stakes) in r:
                 for (coldkey, stake) in coldkey_stakes:
+                    if stake_map.get((hotkey, coldkey)) != stake:
+                        changed[(hotkey, coldkey)] = stake
                     stake_map[(hotkey, coldkey)] = stake
 
             try:
-                for ((hotkey, coldkey), stake) in stake_map.items():
-                    buffer_insert(
-                        table_name,
-                        [n, block_timestamp, f"'{hotkey}'", f"'{coldkey}'", stake]
-                    )
+                if STORAGE_LAYOUT == "changes":
+                    # Snapshot on the first block after a start too, the changes since the last
+                    # snapshot were lost with the in-memory stake map
+                    is_snapshot = last_snapshot_block is None or n % SNAPSHOT_INTERVAL == 0
+                    for ((hotkey, coldkey), stake) in (stake_map if is_snapshot else changed).items():
+                        buffer_insert(
+                            table_name,
+                            [n, block_timestamp, f"'{hotkey}'", f"'{coldkey}'", stake, int(is_snapshot)]
+                        )
+                    if is_snapshot:
+                        last_snapshot_block = n
+                else:
+                    for ((hotkey, coldkey), stake) in stake_map.items():
+                        buffer_insert(
+                            table_name,
+                            [n, block_timestamp, f"'{hotkey}'", f"'{coldkey}'", stake]
+                        )
             except Exception as e:
                 raise DatabaseConnectionError(f"Failed to insert data into buffer: {str(e)}")
 
@@ -0,0 +1,102 @@
+from shared.storage_changes import (
+    StoragePrefixTracker,
+    fetch_proof_nodes,
+    get_state_root,
+    storage_prefix,
+    subtrie_ref,
+    to_nibbles,
+)
+
+NETWORKS_ADDED_PREFIX = storage_prefix("SubtensorModule", "NetworksAdded")
+TEMPO_PREFIX = storage_prefix("SubtensorModule", "Tempo")
+
+# Storage read by query_neuron_info_for_subnets that changes outside of epochs: Keys on
+# registration, Weights and LastUpdate (a map keyed by netuid alone) whenever weights are set,
+# even to the same weights. Everything else it reads is only written by the epoch.
+NEURON_PREFIXES = [
+    storage_prefix("SubtensorModule", storage_function)
+    for storage_function in ("Keys", "Weights", "Bonds", "LastUpdate")
+]
+
+
+def decode_netuid(key):
+    # Identity hashed u16 at the end of the key
+    return int.from_bytes(bytes.fromhex(key[-4:]), "little")
+
+
+def is_epoch_block(netuid, tempo, block_number):
+    """
+    Whether the epoch of a subnet runs in this block, see blocks_until_next_epoch in subtensor.
+    """
+    if tempo == 0:
+        return False
+    return (block_number + netuid + 1) % (tempo + 1) == tempo
+
+
+def find_dirty_subnets(subnet_ids, tempos, previous_refs, refs, block_number):
+    """
+    Returns the subnets to re-read at the block, given the trie node references of their
+    {(prefix, netuid)} at the previous and at this block: subnets without a known tempo, subnets
+    whose epoch runs, and subnets with a new or changed reference.
+    """
+    dirty = set()
+    for netuid in subnet_ids:
+        tempo = tempos.get(netuid)
+        if tempo is None or is_epoch_block(netuid, tempo, block_number):
+            dirty.add(netuid)
+            continue
+        for prefix in NEURON_PREFIXES:
+            key = (prefix, netuid)
+            if key not in previous_refs or refs.get(key) != previous_refs[key]:
+                dirty.add(netuid)
+                break
+    return dirty
+
+
+class DirtySubnetDetector:
+    """
+    Finds the subnets whose neurons may have changed since the previous block: new subnets,
+    subnets whose epoch ran, and subnets with a changed trie node below their (netuid, uid) keys.
+    """
+
+    def __init__(self):
+        self.networks_tracker = StoragePrefixTracker(NETWORKS_ADDED_PREFIX)
+        self.tempo_tracker = StoragePrefixTracker(TEMPO_PREFIX)
+        self.subnet_ids = set()
+        self.tempos = {}
+        # {(prefix, netuid): trie node reference} as of the previous block
+        self.refs = {}
+
+    def update(self, block_number, block_hash):
+        """
+        Returns (every subnet id, dirty subnet ids) at the block.
+        """
+        for (key, value) in self.networks_tracker.update(block_hash).items():
+            netuid = decode_netuid(key)
+            if value is None or value == "0x00":
+                self.subnet_ids.discard(netuid)
+            else:
+                self.subnet_ids.add(netuid)
+
+        for (key, value) in self.tempo_tracker.update(block_hash).items():
+            netuid = decode_netuid(key)
+            if value is None:
+                self.tempos.pop(netuid, None)
+            else:
+                self.tempos[netuid] = int.from_bytes(bytes.fromhex(value[2:]), "little")
+
+        subnet_keys = {
+            (prefix, netuid): prefix + netuid.to_bytes(2, "little").hex()
+            for prefix in NEURON_PREFIXES
+            for netuid in self.subnet_ids
+        }
+        state_root = get_state_root(block_hash)
+        nodes = fetch_proof_nodes(block_hash, list(subnet_keys.values()))
+        refs = {
+            subnet_key: subtrie_ref(nodes, state_root, to_nibbles(bytes.fromhex(key[2:])))
+            for subnet_key, key in subnet_keys.items()
+        }
+
+        dirty = find_dirty_subnets(self.subnet_ids, self.tempos, self.refs, refs, block_number)
+        self.refs = refs
+        return (set(self.subnet_ids), dirty)
@@ -4,13 +4,40 @@ from shared.clickhouse.batch_insert import buffer_insert
 from shared.shovel_base_class import ShovelBaseClass
 import logging
 import rust_bindings
-from shovel_subnets.utils import create_table, get_axon_cache, get_coldkeys_and_stakes, refresh_axon_cache, default_axon
+import os
+from shovel_subnets.utils import (
+    create_as_of_view,
+    create_table,
+    create_vector_tables,
+    write_vector_changes,
+    clear_vectors,
+    get_axon_cache,
+    get_coldkeys_and_stakes,
+    refresh_axon_cache,
+    default_axon,
+)
+from shovel_subnets.dirty_subnets import DirtySubnetDetector
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
 
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(process)d %(message)s")
 
+# Only write a neuron row when something in it changed since the last row written for the neuron
+CHANGED_ONLY = os.getenv("SUBNETS_CHANGED_ONLY", "false").lower() == "true"
+
+# "inline" keeps weights and bonds in every shovel_subnets row, "changes" writes them to
+# shovel_subnet_weights and shovel_subnet_bonds when they change and leaves them empty in shovel_subnets
+WEIGHTS_LAYOUT = os.getenv("SUBNETS_WEIGHTS_LAYOUT", "inline")
+
+dirty_subnet_detector = DirtySubnetDetector()
+
+# subnet_id -> neurons as of the last block the subnet changed
+subnet_neurons = {}
+
+# (subnet_id, neuron_id) -> last written row, without block_number and timestamp
+last_rows = {}
+
 
 class SubnetsShovel(ShovelBaseClass):
     def process_block(self, n):
@@ -27,6 +54,10 @@ def do_process_block(n):
         # Create table if it doesn't exist
         try:
             create_table()
+            if CHANGED_ONLY:
+                create_as_of_view()
+            if WEIGHTS_LAYOUT == "changes":
+                create_vector_tables()
         except Exception as e:
             raise DatabaseConnectionError(f"Failed to create/verify table: {str(e)}")
 
@@ -36,16 +67,38 @@ def do_process_block(n):
             raise ShovelProcessingError(f"Failed to get block metadata: {str(e)}")
 
         try:
-            (neurons, hotkeys) = rust_bindings.query_neuron_info(block_hash)
-            if neurons is None or hotkeys is None:
-                raise ShovelProcessingError("Received None response from query_neuron_info")
+            (subnet_ids, dirty_subnets) = dirty_subnet_detector.update(n, block_hash)
+        except Exception as e:
+            raise ShovelProcessingError(f"Failed to detect changed subnets: {str(e)}")
+
+        try:
+            for subnet_id in list(subnet_neurons.keys()):
+                if subnet_id not in subnet_ids:
+                    del subnet_neurons[subnet_id]
+                    if WEIGHTS_LAYOUT == "changes":
+                        clear_vectors(n, block_timestamp, subnet_id)
+                    for key in [key for key in last_rows if key[0] == subnet_id]:
+                        del last_rows[key]
+
+            # Neurons of the other subnets are carried forward from the block they last changed
+            if dirty_subnets:
+                (neurons, hotkeys) = rust_bindings.query_neuron_info_for_subnets(
+                    block_hash, sorted(dirty_subnets)
+                )
+                if neurons is None or hotkeys is None:
+                    raise ShovelProcessingError("Received None response from query_neuron_info_for_subnets")
+                for subnet_id in dirty_subnets:
+                    subnet_neurons[subnet_id] = []
+                for neuron in neurons:
+                    subnet_neurons[neuron.subnet_id].append(neuron)
+
+            neurons = [neuron for subnet in subnet_neurons.values() for neuron in subnet]
+            hotkeys = [neuron.hotkey for neuron in neurons]
         except Exception as e:
             raise ShovelProcessingError(f"Failed to query neuron info: {str(e)}")
 
         try:
-            coldkeys_and_stakes = get_coldkeys_and_stakes(
-                hotkeys, block_timestamp, block_hash, n
-            )
+            coldkeys_and_stakes = get_coldkeys_and_stakes(hotkeys, block_hash)
             if coldkeys_and_stakes is None:
                 raise ShovelProcessingError("Received None response from get_coldkeys_and_stakes")
         except Exception as e:
@@ -54,7 +107,7 @@ def do_process_block(n):
             raise ShovelProcessingError(f"Failed to get coldkeys and stakes: {str(e)}")
 
         try:
-            refresh_axon_cache(block_timestamp, block_hash, n)
+            refresh_axon_cache(block_hash)
         except Exception as e:
             if isinstance(e, DatabaseConnectionError):
                 raise
@@ -72,7 +125,15 @@ def do_process_block(n):
                     logging.error(f"{hotkey} has no coldkey and stake!")
                     raise ShovelProcessingError(f"Neuron {hotkey} has no coldkey and stake data")
 
-                buffer_insert("shovel_subnets", [
+                if WEIGHTS_LAYOUT == "changes":
+                    write_vector_changes(
+                        n, block_timestamp, neuron.subnet_id, neuron.neuron_id, neuron.weights, neuron.bonds
+                    )
+                    (weights, bonds) = ([], [])
+                else:
+                    (weights, bonds) = (neuron.weights, neuron.bonds)
+
+                row = [
                     n,  # block_number UInt64 CODEC(Delta, ZSTD),
                     block_timestamp,  # timestamp DateTime CODEC(Delta, ZSTD),
                     neuron.subnet_id,  # subnet_id UInt16 CODEC(Delta, ZSTD),
@@ -99,13 +160,21 @@ def do_process_block(n):
                     neuron.validator_trust,            # validator_trust UInt16
                     neuron.dividends,  # dividends UInt16 CODEC(Delta, ZSTD),
                     coldkey_and_stake[1],  # stake UInt64 CODEC(Delta, ZSTD),
-                    neuron.weights,             # weights Array(Tuple(UInt16, UInt16)),
-                    neuron.bonds,  # bonds Array(Tuple(UInt16, UInt16)) CODEC(ZSTD),
+                    weights,             # weights Array(Tuple(UInt16, UInt16)),
+                    bonds,  # bonds Array(Tuple(UInt16, UInt16)) CODEC(ZSTD),
                     neuron.last_update,  # last_update UInt64 CODEC(Delta, ZSTD),
 
                     neuron.validator_permit,
                     neuron.pruning_scores  # pruning_score UInt16 CODEC(Delta, ZSTD)
-                ])
+                ]
+
+                if CHANGED_ONLY:
+                    key = (neuron.subnet_id, neuron.neuron_id)
+                    if last_rows.get(key) == row[2:]:
+                        continue
+                    last_rows[key] = row[2:]
+
+                buffer_insert("shovel_subnets", row)
         except Exception as e:
             if isinstance(e, DatabaseConnectionError):
                 raise
@@ -0,0 +1,55 @@
+import unittest
+
+from shovel_subnets.dirty_subnets import NEURON_PREFIXES, find_dirty_subnets, is_epoch_block
+
+
+def refs_for(netuids, ref=b"a"):
+    return {(prefix, netuid): ref for prefix in NEURON_PREFIXES for netuid in netuids}
+
+
+class IsEpochBlockTest(unittest.TestCase):
+    def test_epoch_blocks(self):
+        # (358 + 1 + 1) % 361 == 360
+        self.assertTrue(is_epoch_block(1, 360, 358))
+        self.assertTrue(is_epoch_block(1, 360, 358 + 361))
+        self.assertFalse(is_epoch_block(1, 360, 359))
+        self.assertFalse(is_epoch_block(2, 360, 358))
+
+    def test_zero_tempo_never_runs(self):
+        for block_number in range(10):
+            self.assertFalse(is_epoch_block(1, 0, block_number))
+
+
+class FindDirtySubnetsTest(unittest.TestCase):
+    def test_unchanged_subnets_are_clean(self):
+        refs = refs_for([1, 2])
+        self.assertEqual(find_dirty_subnets({1, 2}, {1: 360, 2: 360}, refs, dict(refs), 100), set())
+
+    def test_changed_reference_is_dirty(self):
+        previous_refs = refs_for([1, 2])
+        refs = dict(previous_refs)
+        refs[(NEURON_PREFIXES[-1], 2)] = b"b"
+        self.assertEqual(find_dirty_subnets({1, 2}, {1: 360, 2: 360}, previous_refs, refs, 100), {2})
+
+    def test_removed_reference_is_dirty(self):
+        previous_refs = refs_for([1])
+        refs = dict(previous_refs)
+        refs[(NEURON_PREFIXES[0], 1)] = None
+        self.assertEqual(find_dirty_subnets({1}, {1: 360}, previous_refs, refs, 100), {1})
+
+    def test_new_subnet_is_dirty(self):
+        previous_refs = refs_for([1])
+        refs = refs_for([1, 2])
+        self.assertEqual(find_dirty_subnets({1, 2}, {1: 360, 2: 360}, previous_refs, refs, 100), {2})
+
+    def test_unknown_tempo_is_dirty(self):
+        refs = refs_for([1])
+        self.assertEqual(find_dirty_subnets({1}, {}, refs, dict(refs), 100), {1})
+
+    def test_epoch_is_dirty(self):
+        refs = refs_for([1, 2])
+        self.assertEqual(find_dirty_subnets({1, 2}, {1: 360, 2: 360}, refs, dict(refs), 358), {1})
+
+
+if __name__ == "__main__":
+    unittest.main()
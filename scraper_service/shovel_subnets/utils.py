@@ -1,16 +1,14 @@
-from datetime import datetime
-from tqdm import tqdm
-import time
-import os
-import rust_bindings
+from functools import lru_cache
 from shared.substrate import get_substrate_client
+from shared.storage_changes import OWNER_PREFIX, StoragePrefixTracker, storage_prefix
+from shared.clickhouse.batch_insert import buffer_insert
 from shared.clickhouse.utils import (
     get_clickhouse_client,
     table_exists,
 )
 from collections import namedtuple
+from scalecodec.utils.ss58 import ss58_decode, ss58_encode
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
-import logging
 
 Axon = namedtuple('Axon', ['block', 'version', 'ip', 'port',
                   'ip_type', 'protocol', 'placeholder1', 'placeholder2'])
@@ -69,289 +67,250 @@ def create_table():
         raise DatabaseConnectionError(f"Failed to create table: {str(e)}")
 
 
-axon_extrinsics_cache = {}
+# Columns of shovel_subnets after the block and neuron they describe
+NEURON_COLUMNS = [
+    "timestamp", "hotkey", "coldkey", "active",
+    "axon_block", "axon_version", "axon_ip", "axon_port", "axon_ip_type", "axon_protocol",
+    "axon_placeholder1", "axon_placeholder2",
+    "rank", "emission", "incentive", "consensus", "trust", "validator_trust", "dividends",
+    "stake", "weights", "bonds", "last_update", "validator_permit", "pruning_scores",
+]
+
+
+def create_as_of_view():
+    """
+    Creates a parameterized view giving every neuron as of a block, for SUBNETS_CHANGED_ONLY=true
+    where a block only has rows for the neurons that changed in it:
+
+        SELECT * FROM shovel_subnets_as_of(block_number = 4000000)
+    """
+    if table_exists("shovel_subnets_as_of"):
+        return
+    columns = ",\n".join(
+        f"                argMax({column}, block_number) AS {column}" for column in NEURON_COLUMNS
+    )
+    query = f"""
+            CREATE VIEW IF NOT EXISTS shovel_subnets_as_of AS
+            SELECT
+                subnet_id,
+                neuron_id,
+{columns},
+                max(block_number) AS changed_at_block
+            FROM shovel_subnets
+            WHERE block_number <= {{block_number:UInt64}}
+            GROUP BY subnet_id, neuron_id
+            """
+    try:
+        get_clickhouse_client().execute(query)
+    except Exception as e:
+        raise DatabaseConnectionError(f"Failed to create shovel_subnets_as_of: {str(e)}")
 
 
-axon_cache = {}
+# Neuron vectors written to their own change-log tables with SUBNETS_WEIGHTS_LAYOUT=changes
+VECTOR_TABLES = {
+    "weights": "shovel_subnet_weights",
+    "bonds": "shovel_subnet_bonds",
+}
 
-
-def get_axon_cache():
-    return axon_cache
+# (table, subnet_id, neuron_id) -> vector as of the last row written
+last_vectors = {}
 
 
-def refresh_axon_cache(block_timestamp, block_hash, block_number):
-    global axon_cache
+def create_vector_tables():
+    """
+    Creates the weights and bonds change-log tables, a row per neuron whose vector changed, and
+    their parameterized as-of views:
 
-    try:
-        extrinsics_synced_block_query = f"SELECT block_number FROM shovel_checkpoints FINAL WHERE shovel_name = 'extrinsics';"
-        try:
-            result = get_clickhouse_client().execute(extrinsics_synced_block_query)
-            if not result:
-                raise DatabaseConnectionError("No checkpoint found for extrinsics shovel")
-            extrinsics_synced_block = result[0][0]
-        except Exception as e:
-            raise DatabaseConnectionError(f"Failed to query extrinsics sync status: {str(e)}")
-
-        while (extrinsics_synced_block < block_number):
-            logging.info("Waiting for extrinsics table to sync...")
-            time.sleep(60)
+        SELECT * FROM shovel_subnet_weights_as_of(block_number = 4000000)
+    """
+    for (column, table) in VECTOR_TABLES.items():
+        if not table_exists(table):
+            query = f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                block_number UInt64 CODEC(Delta, ZSTD),
+                timestamp DateTime CODEC(Delta, ZSTD),
+                subnet_id UInt16 CODEC(Delta, ZSTD),
+                neuron_id UInt16 CODEC(Delta, ZSTD),
+                {column} Array(Tuple(UInt16, UInt16)) CODEC(ZSTD)
+            ) ENGINE = ReplacingMergeTree()
+            ORDER BY (subnet_id, neuron_id, block_number)
+            """
             try:
-                result = get_clickhouse_client().execute(extrinsics_synced_block_query)
-                if not result:
-                    raise DatabaseConnectionError("No checkpoint found for extrinsics shovel")
-                extrinsics_synced_block = result[0][0]
+                get_clickhouse_client().execute(query)
             except Exception as e:
-                raise DatabaseConnectionError(f"Failed to query extrinsics sync status during wait: {str(e)}")
-    except Exception as e:
-        if isinstance(e, DatabaseConnectionError):
-            raise
-        raise DatabaseConnectionError(f"Failed to check extrinsics sync status: {str(e)}")
-
-    # Init the axon cache on first run
-    if len(axon_cache) == 0:
-        try:
-            logging.info("Initializing axon cache...")
-            axon_cache = rust_bindings.query_axons(block_hash)
-            if axon_cache is None:
-                raise ShovelProcessingError("Received None response from query_axons")
-            logging.info("Initialized axon cache")
-        except Exception as e:
-            if "DatabaseConnectionError" in str(type(e)):
-                raise
-            raise ShovelProcessingError(f"Failed to initialize axon cache: {str(e)}")
+                raise DatabaseConnectionError(f"Failed to create {table}: {str(e)}")
 
-    # Get events this block
-    if block_timestamp not in axon_extrinsics_cache:
-        try:
-            # get any axon extrinsics this block
-            dt_object = datetime.fromtimestamp(block_timestamp)
-            formatted_date = dt_object.strftime("%Y-%m-%d %H:%M:%S")
+        if not table_exists(f"{table}_as_of"):
             query = f"""
-                SELECT address, arg_netuid, arg_version, arg_ip, arg_port, arg_ip_type, arg_protocol, arg_placeholder1, arg_placeholder2
-                FROM shovel_extrinsics_SubtensorModule_serve_axon_v0
-                WHERE timestamp = '{formatted_date}' AND success = True
+            CREATE VIEW IF NOT EXISTS {table}_as_of AS
+            SELECT
+                subnet_id,
+                neuron_id,
+                argMax({column}, block_number) AS {column},
+                max(block_number) AS changed_at_block
+            FROM {table}
+            WHERE block_number <= {{block_number:UInt64}}
+            GROUP BY subnet_id, neuron_id
             """
             try:
-                axon_events = get_clickhouse_client().execute(query)
+                get_clickhouse_client().execute(query)
             except Exception as e:
-                raise DatabaseConnectionError(f"Failed to execute axon events query: {str(e)}")
-
-            if axon_events is None:
-                raise ShovelProcessingError("Received None response from axon events query")
-            axon_extrinsics_cache[block_timestamp] = axon_events
-        except Exception as e:
-            if isinstance(e, (DatabaseConnectionError, ShovelProcessingError)):
-                raise
-            raise DatabaseConnectionError(f"Failed to fetch axon events: {str(e)}")
+                raise DatabaseConnectionError(f"Failed to create {table}_as_of: {str(e)}")
 
-        for e in axon_events:
-            try:
-                if len(e) < 9:
-                    raise ShovelProcessingError(f"Invalid axon event data: expected 9 fields, got {len(e)}")
-
-                hotkey = e[0]
-                subnet_id = e[1]
-                version = e[2]
-                ip = e[3]
-                port = e[4]
-                ip_type = e[5]
-                protocol = e[6]
-                placeholder1 = e[7]
-                placeholder2 = e[8]
-
-                if not all(x is not None for x in [hotkey, subnet_id, version, ip, port, ip_type, protocol, placeholder1, placeholder2]):
-                    raise ShovelProcessingError(f"Invalid axon event data: contains None values")
-
-                logging.info(f"Updating axon cache for {subnet_id}:{hotkey}")
-                axon_cache[(subnet_id, hotkey)] = Axon(
-                    block=block_number,
-                    version=version,
-                    ip=ip,
-                    port=port,
-                    ip_type=ip_type,
-                    protocol=protocol,
-                    placeholder1=placeholder1,
-                    placeholder2=placeholder2
-                )
-            except Exception as e:
-                if isinstance(e, ShovelProcessingError):
-                    raise
-                raise ShovelProcessingError(f"Failed to process axon event: {str(e)}")
 
+def write_vector_changes(block_number, block_timestamp, subnet_id, neuron_id, weights, bonds):
+    """
+    Writes the weights and bonds of a neuron to their change-log tables if they changed since the
+    last row written for the neuron. The first block after a restart writes every vector.
+    """
+    for (table, vector) in ((VECTOR_TABLES["weights"], weights), (VECTOR_TABLES["bonds"], bonds)):
+        key = (table, subnet_id, neuron_id)
+        if last_vectors.get(key) == vector:
+            continue
+        last_vectors[key] = vector
+        buffer_insert(table, [block_number, block_timestamp, subnet_id, neuron_id, vector])
 
-coldkey_stake_cache = {}
 
-hotkey_owner_map_synced_block = -1
+def clear_vectors(block_number, block_timestamp, subnet_id):
+    """
+    Writes empty weights and bonds for every neuron of a removed subnet.
+    """
+    for key in [key for key in last_vectors if key[1] == subnet_id]:
+        (table, _, neuron_id) = key
+        del last_vectors[key]
+        buffer_insert(table, [block_number, block_timestamp, subnet_id, neuron_id, []])
 
-stake_map_synced_block = -1
 
-stake_map_synced_block_query = "SELECT block_number FROM shovel_checkpoints FINAL WHERE shovel_name = 'stake_double_map';"
-hotkey_owner_map_synced_block_query = "SELECT block_number FROM shovel_checkpoints FINAL WHERE shovel_name = 'hotkey_owner_map';"
+AXONS_PREFIX = storage_prefix("SubtensorModule", "Axons")
 
+axons_tracker = StoragePrefixTracker(AXONS_PREFIX)
 
-def batch(iterable, n=1):
-    if not iterable:
-        return []
-    length = len(iterable)
-    for i in range(0, length, n):
-        yield iterable[i:i + n]
+# (subnet_id, hotkey) -> Axon as of the last block read
+axon_cache = {}
 
 
-def get_coldkeys_and_stakes(hotkeys, block_timestamp, block_hash, block_number):
-    if not hotkeys:
-        raise ShovelProcessingError("Empty hotkeys list provided")
+def get_axon_cache():
+    return axon_cache
 
-    global coldkey_stake_cache
-    global stake_map_synced_block
-    global hotkey_owner_map_synced_block
 
+def decode_axon(value):
+    """
+    Decodes a SCALE encoded AxonInfo: block u64, version u32, ip u128, port u16, then ip_type,
+    protocol, placeholder1 and placeholder2 as u8.
+    """
+    data = bytes.fromhex(value[2:])
+    if len(data) < 34:
+        raise ShovelProcessingError(f"Invalid axon data: expected 34 bytes, got {len(data)}")
+    return Axon(
+        block=int.from_bytes(data[0:8], "little"),
+        version=int.from_bytes(data[8:12], "little"),
+        ip=int.from_bytes(data[12:28], "little"),
+        port=int.from_bytes(data[28:30], "little"),
+        ip_type=data[30],
+        protocol=data[31],
+        placeholder1=data[32],
+        placeholder2=data[33]
+    )
+
+
+def refresh_axon_cache(block_hash):
+    """
+    Brings the axon cache to the block by reading only the changed shards of the Axons map, keyed
+    by Identity(netuid) ++ Blake2_128Concat(hotkey). The first call reads the whole map.
+    """
     try:
-        while (hotkey_owner_map_synced_block < block_number or stake_map_synced_block < block_number):
-            if hotkey_owner_map_synced_block > -1 and stake_map_synced_block > -1:
-                logging.info("Waiting for stake_double_map and hotkey_owner_map tables to sync...")
-                time.sleep(1)
-            try:
-                stake_result = get_clickhouse_client().execute(stake_map_synced_block_query)
-                hotkey_result = get_clickhouse_client().execute(hotkey_owner_map_synced_block_query)
-
-                if not stake_result or not hotkey_result:
-                    raise DatabaseConnectionError("No checkpoint found for stake_map or hotkey_owner_map")
-
-                stake_map_synced_block = stake_result[0][0]
-                hotkey_owner_map_synced_block = hotkey_result[0][0]
-            except Exception as e:
-                raise DatabaseConnectionError(f"Failed to query dependency sync status: {str(e)}")
+        changes = axons_tracker.update(block_hash)
     except Exception as e:
-        if isinstance(e, DatabaseConnectionError):
-            raise
-        raise DatabaseConnectionError(f"Failed to check dependency sync status: {str(e)}")
+        raise ShovelProcessingError(f"Failed to read axon changes: {str(e)}")
 
-    need_to_query = []
-    for hotkey in hotkeys:
-        if (block_timestamp, hotkey) not in coldkey_stake_cache:
-            need_to_query.append(hotkey)
-
-    # track the block timestamps because we need them to fill in zero stake
-    # amount cache later
-    block_timestamps = set()
-    block_timestamps.add(block_timestamp)
-    if len(need_to_query) > 0:
+    ss58_format = get_substrate_client().ss58_format
+    for (key, value) in changes.items():
         try:
-            clickhouse = get_clickhouse_client()
-            batch_size = 1000
-            responses = []
-            dt_object = datetime.fromtimestamp(block_timestamp)
-            formatted_date = dt_object.strftime("%Y-%m-%d %H:%M:%S")
-            logging.info(
-                f"Querying {len(need_to_query) / batch_size} batches of coldkeys and stakes"
-            )
-            for hotkey_batch in tqdm(batch(need_to_query, batch_size)):
-                if not hotkey_batch:
-                    continue
-
-                hotkeys_list = "', '".join(hotkey_batch)
-                hotkeys_str = f"('{hotkeys_list}')"
-                query = f"""
-                        SELECT
-                            timestamp,
-                            hotkey,
-                            coldkey,
-                            stake
-                        FROM shovel_hotkey_owner_map AS o
-                        INNER JOIN shovel_stake_double_map AS s
-                        ON o.timestamp = s.timestamp AND o.coldkey = s.coldkey AND o.hotkey = s.hotkey
-                        WHERE hotkey IN {hotkeys_str}
-                        AND timestamp >= '{formatted_date}' AND timestamp < addMinutes('{formatted_date}', 30)
-                    """
-                try:
-                    r = clickhouse.execute(query)
-                    if r is None:
-                        raise DatabaseConnectionError("Received None response from coldkeys and stakes query")
-                    responses.extend(r)
-                except Exception as e:
-                    raise DatabaseConnectionError(f"Failed to execute coldkeys and stakes query: {str(e)}")
+            subnet_id = int.from_bytes(bytes.fromhex(key[-100:-96]), "little")
+            hotkey = to_address(key[-64:], ss58_format)
+            if value is None:
+                axon_cache.pop((subnet_id, hotkey), None)
+            else:
+                axon_cache[(subnet_id, hotkey)] = decode_axon(value)
         except Exception as e:
-            if isinstance(e, DatabaseConnectionError):
+            if isinstance(e, ShovelProcessingError):
                 raise
-            raise DatabaseConnectionError(f"Failed to query coldkeys and stakes: {str(e)}")
+            raise ShovelProcessingError(f"Failed to process axon change: {str(e)}")
 
-        for response in responses:
-            try:
-                if len(response) < 4:
-                    raise ShovelProcessingError(f"Invalid response data: expected 4 fields, got {len(response)}")
 
-                timestamp = int(response[0].timestamp())
-                hotkey = response[1]
-                coldkey = response[2]
-                stake = response[3]
+STAKE_PREFIX = storage_prefix("SubtensorModule", "Stake")
 
-                if not all(x is not None for x in [timestamp, hotkey, coldkey, stake]):
-                    raise ShovelProcessingError(f"Invalid response data: contains None values")
+owner_tracker = StoragePrefixTracker(OWNER_PREFIX)
+stake_tracker = StoragePrefixTracker(STAKE_PREFIX)
 
-                block_timestamps.add(timestamp)
-                coldkey_stake_cache[(timestamp, hotkey)] = (coldkey, stake)
-            except Exception as e:
-                raise ShovelProcessingError(f"Failed to process response data: {str(e)}")
+# Owner and Stake as of the last block read, by hex public key
+owners = {}
+stakes = {}
+
+
+@lru_cache(maxsize=None)
+def to_public_key(address, ss58_format):
+    return ss58_decode(address, ss58_format)
 
+
+@lru_cache(maxsize=None)
+def to_address(public_key, ss58_format):
+    return ss58_encode(public_key, ss58_format)
+
+
+def apply_stake_changes(owner_changes, stake_changes):
+    """
+    Applies changed Owner entries, keyed by Blake2_128Concat(hotkey) with the coldkey as value, and
+    changed Stake entries, keyed by Identity(hotkey) ++ Identity(coldkey) with a u64 as value.
+    """
+    for (key, value) in owner_changes.items():
+        hotkey = key[-64:]
+        if value is None:
+            owners.pop(hotkey, None)
+        else:
+            owners[hotkey] = value[2:]
+
+    for (key, value) in stake_changes.items():
+        hotkey_and_coldkey = (key[-128:-64], key[-64:])
+        if value is None:
+            stakes.pop(hotkey_and_coldkey, None)
+        else:
+            stakes[hotkey_and_coldkey] = int.from_bytes(bytes.fromhex(value[2:]), "little")
+
+
+def get_coldkeys_and_stakes(hotkeys, block_hash):
+    """
+    Returns {hotkey: (coldkey, stake)} at the block, the stake being that of the owning coldkey.
+
+    The Owner and Stake maps are kept in memory and brought to the block by reading only their
+    changed shards, so every lookup is a dictionary hit. Only the current block is kept, there
+    is nothing to evict.
+    """
+    if not hotkeys:
+        raise ShovelProcessingError("Empty hotkeys list provided")
+
+    try:
+        owner_changes = owner_tracker.update(block_hash)
+        stake_changes = stake_tracker.update(block_hash)
+    except Exception as e:
+        raise ShovelProcessingError(f"Failed to read owner and stake changes: {str(e)}")
+
+    apply_stake_changes(owner_changes, stake_changes)
+
+    ss58_format = get_substrate_client().ss58_format
     coldkeys_and_stakes = dict()
     for hotkey in hotkeys:
         try:
-            # handle a hotkey without a stake
-            if (block_timestamp, hotkey) not in coldkey_stake_cache:
-                try:
-                    coldkey_result = get_substrate_client().query(
-                        "SubtensorModule",
-                        "Owner",
-                        block_hash=block_hash,
-                        params=[hotkey],
-                    )
-                    if coldkey_result is None or coldkey_result.value is None:
-                        raise ShovelProcessingError(f"Failed to get coldkey for hotkey {hotkey}")
-                    coldkey = coldkey_result.value
-
-                    stake = get_substrate_client().query(
-                        "SubtensorModule",
-                        "Stake",
-                        block_hash=block_hash,
-                        params=[hotkey, coldkey],
-                    )
-                    if stake is None:
-                        raise ShovelProcessingError(f"Failed to get stake for hotkey {hotkey}")
-                except Exception as e:
-                    raise ShovelProcessingError(f"Failed to query substrate for hotkey {hotkey}: {str(e)}")
-
-                if stake != 0:
-                    logging.error(
-                        f"ERROR: Hotkey {hotkey} has stake {stake} but not in Clickhouse"
-                    )
-                    raise ShovelProcessingError(f"Inconsistent stake data for hotkey {hotkey}")
-                for t in block_timestamps:
-                    coldkey_stake_cache[(t, hotkey)] = (coldkey, stake)
-
-            # we should have stakes for all hotkeys now!
-            try:
-                coldkey, stake = coldkey_stake_cache[(block_timestamp, hotkey)]
-                if coldkey is None or stake is None:
-                    raise ShovelProcessingError(f"Invalid cache data for hotkey {hotkey}")
-                coldkeys_and_stakes[hotkey] = (coldkey, stake)
-            except KeyError:
-                raise ShovelProcessingError(f"Missing cache data for hotkey {hotkey}")
+            public_key = to_public_key(hotkey, ss58_format)
+            coldkey = owners.get(public_key)
+            if coldkey is None:
+                raise ShovelProcessingError(f"Failed to get coldkey for hotkey {hotkey}")
+            # Stake is a ValueQuery, a missing entry is no stake
+            stake = stakes.get((public_key, coldkey), 0)
+            coldkeys_and_stakes[hotkey] = (to_address(coldkey, ss58_format), stake)
         except Exception as e:
-            if isinstance(e, (DatabaseConnectionError, ShovelProcessingError)):
+            if isinstance(e, ShovelProcessingError):
                 raise
             raise ShovelProcessingError(f"Failed to process hotkey {hotkey}: {str(e)}")
 
-    # periodically clear out historical keys
-    if len(coldkey_stake_cache) > 1_000_000:
-        logging.info("Clearing historical coldkey_stake_cache")
-        deleted = 0
-        keys_to_delete = []
-        for (timestamp, hotkey) in coldkey_stake_cache.keys():
-            if timestamp < block_timestamp:
-                keys_to_delete.append((timestamp, hotkey))
-        for key in keys_to_delete:
-            del coldkey_stake_cache[key]
-            deleted += 1
-        logging.info(f"Deleted {deleted} keys, {len(coldkey_stake_cache)} remain")
-
     return coldkeys_and_stakes
@@ -5,9 +5,10 @@ from shared.clickhouse.utils import (
     get_clickhouse_client,
     table_exists,
 )
-from shared.shovel_base_class import ShovelBaseClass
+from shared.snapshot_shovel_base_class import SnapshotShovelBaseClass
 from shared.exceptions import DatabaseConnectionError, ShovelProcessingError
-from substrate import get_substrate_client
+from shared.substrate import close_substrate_client as close_shared_substrate_client
+from substrate import close_substrate_client, get_substrate_client
 import logging
 from typing import Dict, List, Any
 from typing import Union
@@ -171,16 +172,19 @@ def fetch_validator_stats(substrate, address: str, block_hash: str, delegate_inf
             "subnet_hotkey_alpha": {}
         }
 
-class ValidatorsShovel(ShovelBaseClass):
+class ValidatorsShovel(SnapshotShovelBaseClass):
     table_name = "shovel_validators"
 
     def __init__(self, name):
         super().__init__(name)
         self.starting_block = FIRST_DTAO_BLOCK
 
-    def process_block(self, n):
-        if n % 7200 != 0:
-            return
+    def close_backfill_client(self):
+        # Block metadata goes through the shared client, the runtime calls through our own
+        close_shared_substrate_client()
+        close_substrate_client()
+
+    def process_snapshot(self, n):
         try:
             logging.info(f"Processing block {n}")
             substrate = get_substrate_client()
@@ -249,12 +253,6 @@ class ValidatorsShovel(ShovelBaseClass):
             logging.info(f"- Successful inserts: {successful_inserts}")
             logging.info(f"- Failed inserts: {len(validators) - successful_inserts}")
 
-            logging.info(f"Mannually updating shovel_checkpoints for block {n}")
-
-            buffer_insert(
-                "shovel_checkpoints",
-                [f"'{self.name}'", n],
-            )
             logging.info(f"Done, processing another block")
 
         except DatabaseConnectionError as e:
@@ -13,6 +13,14 @@ def get_substrate_client():
     return thread_local.client
 
 
+def close_substrate_client():
+    if hasattr(thread_local, "client"):
+        try:
+            thread_local.client.close()
+        finally:
+            del thread_local.client
+
+
 def reconnect_substrate():
     print("Reconnecting Substrate...")
     if hasattr(thread_local, "client"):